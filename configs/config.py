@@ -17,8 +17,20 @@ def set_cfg(cfg):
     cfg.seed = 111
     cfg.lr = 1e-3
     cfg.epochs = 300000
+    cfg.fuse_steps = 10
+    # persistent compilation cache ('': off)
+    cfg.cache_dir = './results/jax_cache'
+    # run the training step and eval function from ahead-of-time exports in cache_dir
+    cfg.aot = False
+    # checkpoint params, optimizer state, RBA weights and best loss of each window every...
+    cfg.ckpt_iter = 10000
+    # continue each window from its checkpoint, if there is one
+    cfg.resume = False
+    cfg.devices = 1
+    cfg.shard_axis = 0
     cfg.offset_num = 8
     cfg.offset_iter = 100
+    cfg.offset_mode = 'random'
     cfg.lbda_c = 5000.0
     cfg.lbda_rho = 1000.0
     cfg.lbda_w = 1.0
@@ -32,13 +44,35 @@ def set_cfg(cfg):
     cfg.n_layers = 3
     cfg.features = 128
     cfg.r = 128
+    cfg.rank_devices = 1
     cfg.out_dim = 3
     cfg.pos_enc = 5
+    cfg.contraction = 'streamed'
+    cfg.mem_cap = 0
+    cfg.precision = 'fp32'
 
     # time marching
     cfg.marching_steps = 10
     cfg.step_idx = 0
     cfg.time_end = 2.0
+    # run windows step_idx, ..., marching_steps-1 in one process (ICs passed on in memory)
+    cfg.march = False
+    # write each next IC to IC_pred/ (needed when windows run as separate processes)
+    cfg.save_ic = True
+    # with march, start each window from the previous one ('none': fresh init; 'continue': previous
+    # params, continuous with the new IC; 'shift': temporal body network translated to the new
+    # window, which repeats the previous window's profile and starts from its IC, not the new one)
+    cfg.warm_start = 'none'
+    # warm-started windows stop once their loss reaches the best loss of the previous window
+    cfg.auto_epochs = True
+    # train windows step_idx, ..., marching_steps-1 at once in a process pool, for at most this
+    # many parareal iterations (0: off), until no IC changes by more than parareal_tol
+    cfg.parareal = 0
+    cfg.parareal_tol = 1e-3
+    # training epochs of the coarse windows predicting the parareal ICs
+    cfg.coarse_epochs = 5000
+    # worker processes of the parareal pool (0: one per window, at most one per core)
+    cfg.workers = 0
 
     # log settings
     cfg.log_iter = 1000
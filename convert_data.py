@@ -0,0 +1,18 @@
+import argparse
+
+from utils.data_generators import convert_diffusion3d
+
+
+if __name__ == '__main__':
+    # config
+    parser = argparse.ArgumentParser(description='Convert reference data into a single memory-mapped store')
+
+    # data directory
+    parser.add_argument('--data_dir', type=str, default='./data/diffusion3d', help='a directory to gt data')
+    parser.add_argument('--equation', type=str, default='diffusion3d', choices=['diffusion3d'], help='equation of the reference data')
+
+    args = parser.parse_args()
+
+    if args.equation == 'diffusion3d':
+        path = convert_diffusion3d(args.data_dir)
+    print(f'reference store --> {path}.npy, {path}.json')
@@ -5,47 +5,68 @@ import time
 import jax
 import numpy as np
 import optax
+from networks.factorized_derivatives import axis_derivatives, contract, face_derivatives
 from networks.hessian_vector_products import *
 from tqdm import trange
-from utils.data_generators import generate_test_data, generate_train_data
+from utils.checkpoints import CheckpointWriter, load_tree, save_tree
+from utils.data_generators import TrainSampler, generate_test_data
+from utils.data_utils import attach_factors, detach_factors
 from utils.eval_functions import setup_eval_function
+from utils.factor_tables import export_factor_tables, spinn_layout
 from utils.training_utils import *
 
 
-@partial(jax.jit, static_argnums=(0,))
-def apply_model_spinn(apply_fn, params, *train_data):
-    def residual_loss(params, t, x, y, z, source_term):
-        # compute u
-        u = apply_fn(params, t, x, y, z)
-        # tangent vector dx/dx
-        # assumes t, x, y, z have same shape (very important)
-        v = jnp.ones(t.shape)
-        # 2nd derivatives of u
-        utt = hvp_fwdfwd(lambda t: apply_fn(params, t, x, y, z), (t,), (v,))
-        uxx = hvp_fwdfwd(lambda x: apply_fn(params, t, x, y, z), (x,), (v,))
-        uyy = hvp_fwdfwd(lambda y: apply_fn(params, t, x, y, z), (y,), (v,))
-        uzz = hvp_fwdfwd(lambda z: apply_fn(params, t, x, y, z), (z,), (v,))
-        return jnp.mean((utt - uxx - uyy - uzz + u**2 - source_term)**2)
+# squared residual at each point of the (t, x, y, z) collocation grid (SPINN)
+def residual_spinn(apply_fn, params, t, x, y, z, source_term):
+    # per-axis features and their 1st, 2nd derivatives
+    tables = axis_derivatives(apply_fn, params, t, x, y, z, order=2)
+    # compute u
+    u = contract(tables, (0, 0, 0, 0))
+    # 2nd derivatives of u
+    utt = contract(tables, (2, 0, 0, 0))
+    uxx = contract(tables, (0, 2, 0, 0))
+    uyy = contract(tables, (0, 0, 2, 0))
+    uzz = contract(tables, (0, 0, 0, 2))
+    return (utt - uxx - uyy - uzz + u**2 - source_term)**2
+
+
+# squared residual over the full collocation grid, tile by tile (and device by device),
+# the source term contracted from its per-axis factor tables one tile at a time
+def residual_grid(apply_fn, params, *train_data, n_tiles=1, axis=0, mesh=None):
+    tc, xc, yc, zc, uc = train_data[:5]
+    fn = lambda *axes: residual_spinn(apply_fn, params, *detach_factors(axes))
+    return tiled_map(fn, attach_factors((tc, xc, yc, zc), uc), axis=axis, n_tiles=n_tiles, mesh=mesh)
+
+
+@partial(jax.jit, static_argnums=(0,), static_argnames=('n_tiles', 'axis', 'mesh'))
+def apply_model_spinn(apply_fn, params, *train_data, n_tiles=1, axis=0, mesh=None):
+    def residual_loss(params, *axes):
+        return jnp.mean(residual_spinn(apply_fn, params, *detach_factors(axes)))
 
     def initial_loss(params, t, x, y, z, u):
         return jnp.mean((apply_fn(params, t, x, y, z) - u)**2)
 
     def boundary_loss(params, t, x, y, z, u):
+        # every face from one evaluation of the body networks
         loss = 0.
-        for i in range(6):
-            loss += (1/6.) * jnp.mean((apply_fn(params, t[i], x[i], y[i], z[i]) - u[i])**2)
+        for tables, u_face in zip(face_derivatives(apply_fn, params, t, x, y, z), u):
+            loss += (1/6.) * jnp.mean((contract(tables, (0, 0, 0, 0)) - u_face)**2)
         return loss
 
     # unpack data
     tc, xc, yc, zc, uc, ti, xi, yi, zi, ui, tb, xb, yb, zb, ub = train_data
 
     # isolate loss func from redundant arguments
-    loss_fn = lambda params: residual_loss(params, tc, xc, yc, zc, uc) + \
-                        initial_loss(params, ti, xi, yi, zi, ui) + \
+    loss_fn = lambda params: initial_loss(params, ti, xi, yi, zi, ui) + \
                         boundary_loss(params, tb, xb, yb, zb, ub)
 
     loss, gradient = jax.value_and_grad(loss_fn)(params)
 
+    # residual loss over the full grid, tile by tile (and device by device) along one grid axis
+    # (source term contracted from its per-axis factor tables within each tile)
+    res_loss, res_gradient = tiled_value_and_grad(residual_loss, params, attach_factors((tc, xc, yc, zc), uc), axis=axis, n_tiles=n_tiles, mesh=mesh)
+    loss, gradient = loss + res_loss, jax.tree_util.tree_map(jnp.add, gradient, res_gradient)
+
     return loss, gradient
 
 
@@ -96,14 +117,26 @@ if __name__ == '__main__':
     parser.add_argument('--seed', type=int, default=111, help='random seed')
     parser.add_argument('--lr', type=float, default=1e-3, help='learning rate')
     parser.add_argument('--epochs', type=int, default=50000, help='training epochs')
+    parser.add_argument('--fuse_steps', type=int, default=10, help='training epochs fused into one compiled step')
+    parser.add_argument('--cache_dir', type=str, default='./results/jax_cache', help='persistent compilation cache (empty: off)')
+    parser.add_argument('--aot', type=int, default=0, help='run the training step and eval function from ahead-of-time exports in cache_dir, exported by the first run')
+    parser.add_argument('--ckpt_iter', type=int, default=10000, help='checkpoint params, optimizer state and sampler every...')
+    parser.add_argument('--resume', type=int, default=0, help='continue from the checkpoint in the result directory, if there is one')
+    parser.add_argument('--resample_iter', type=int, default=100, help='resample training data every...')
+    parser.add_argument('--sampling', type=str, default='uniform', choices=['uniform', 'residual'], help='collocation sampling of spinn (uniform; residual: per-axis densities from the residual marginals)')
+    parser.add_argument('--devices', type=int, default=1, help='the number of devices for data-parallel training (zero for all devices)')
+    parser.add_argument('--shard_axis', type=int, default=0, help='grid axis sharded across devices (and split into tiles)')
 
     # model settings
     parser.add_argument('--mlp', type=str, default='modified_mlp', choices=['mlp', 'modified_mlp'], help='type of mlp')
     parser.add_argument('--n_layers', type=int, default=3, help='the number of layer')
     parser.add_argument('--features', type=int, default=64, help='feature size of each layer')
     parser.add_argument('--r', type=int, default=32, help='rank of the approximated tensor')
+    parser.add_argument('--contraction', type=str, default='batched', choices=['batched', 'streamed'], help='merge of per-axis features (batched: single einsum; streamed: never builds the rank-expanded intermediate)')
+    parser.add_argument('--mem_cap', type=float, default=0, help='memory cap (MB) for the residual loss, split into tiles above it (zero if no cap)')
     parser.add_argument('--out_dim', type=int, default=1, help='size of model output')
     parser.add_argument('--pos_enc', type=int, default=0, help='size of the positional encoding (zero if no encoding)')
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'], help='dtype policy of the networks (fp32; bf16: bf16 body networks, fp32 contraction and derivatives)')
 
     # PDE settings
     parser.add_argument('--k', type=int, default=2, help='temporal frequency of the solution')
@@ -112,6 +145,9 @@ if __name__ == '__main__':
     parser.add_argument('--log_iter', type=int, default=1000, help='print log every...')
 
     args = parser.parse_args()
+    # training runs in whole chunks of fuse_steps epochs
+    if args.epochs % args.fuse_steps != 0:
+        parser.error(f'--epochs ({args.epochs}) must be a multiple of --fuse_steps ({args.fuse_steps})')
 
     # random key
     key = jax.random.PRNGKey(args.seed)
@@ -139,56 +175,96 @@ if __name__ == '__main__':
 
     # dataset
     key, subkey = jax.random.split(key, 2)
-    train_data = generate_train_data(args, subkey, result_dir=result_dir)
+    # (kept on device and resampled within the training step every args.resample_iter epochs)
+    sampler = TrainSampler(args, subkey, args.resample_iter, result_dir=result_dir)
+    train_data = sampler.data
     test_data = generate_test_data(args, result_dir)
 
     # loss & evaluation function
     eval_fn = setup_eval_function(args.model, args.equation)
+    if args.aot:
+        eval_fn = aot(eval_fn, export_prefix(args, 'eval'), n_static=1)
+
+    # devices for data-parallel training, the residual grid is sharded along args.shard_axis
+    mesh = setup_mesh(args.devices)
+
+    # split the residual grid into tiles that fit the memory cap
+    n_tiles = 1
+    if args.model == 'spinn':
+        n_tiles = tiles_for_memory(apply_model_spinn, (apply_fn, params, *train_data), train_data[args.shard_axis].shape[0], args.mem_cap, axis=args.shard_axis, mesh=mesh)
+        if args.sampling == 'residual':
+            # collocation axes of each new batch drawn from the per-axis residual marginals
+            sampler.residual_fn = partial(residual_grid, apply_fn, n_tiles=n_tiles, axis=args.shard_axis, mesh=mesh)
 
     # save training configuration
     save_config(args, result_dir)
 
+    # checkpoint of this run, continued from with --resume (log kept)
+    ckpt_path = os.path.join(result_dir, 'checkpoint.npz')
+    resume = args.resume and os.path.exists(ckpt_path)
+
     # log
     logs = []
-    if os.path.exists(os.path.join(result_dir, 'log (loss, error).csv')):
+    if not resume and os.path.exists(os.path.join(result_dir, 'log (loss, error).csv')):
         os.remove(os.path.join(result_dir, 'log (loss, error).csv'))
     if os.path.exists(os.path.join(result_dir, 'best_error.csv')):
         os.remove(os.path.join(result_dir, 'best_error.csv'))
     best = 100000.
 
+    # loss/gradient step, fused with the update over args.fuse_steps epochs
+    if args.model == 'spinn':
+        step_fn = partial(apply_model_spinn, apply_fn, n_tiles=n_tiles, axis=args.shard_axis, mesh=mesh)
+    elif args.model == 'pinn':
+        step_fn = partial(apply_model_pinn, apply_fn)
+    train_steps = make_train_steps(step_fn, optim, args.fuse_steps, best_every=10, sampler=sampler, export=export_prefix(args, 'train'))
+    best_params = params
+
+    # params, optimizer state, best loss, epoch and sampler (key and current batch), written in
+    # the background every args.ckpt_iter epochs
+    checkpoint = lambda e: {'params': params, 'state': state, 'best': best, 'best_params': best_params, 'epoch': e, 'key': sampler.key, 'data': sampler.data}
+    writer, e0 = CheckpointWriter(ckpt_path), 0
+    if resume:
+        # same shapes and dtypes as a fresh start: the training step is still compiled once
+        ckpt = load_tree(ckpt_path, checkpoint(e0))
+        params, state, best, best_params, e0 = ckpt['params'], ckpt['state'], ckpt['best'], ckpt['best_params'], int(ckpt['epoch'])
+        sampler.key, sampler.data = ckpt['key'], ckpt['data']
+        best_error = eval_fn(apply_fn, best_params, *test_data)
+        print(f'Resuming from epoch {e0}')
+
     # start training
-    for e in trange(1, args.epochs + 1):
-        if e == 2:
+    start = time.time()
+    for e in trange(e0 + args.fuse_steps, args.epochs + 1, args.fuse_steps):
+        if e == e0 + 2*args.fuse_steps:
             # exclude compiling time
             start = time.time()
 
-        if e % 100 == 0:
-            # sample new input data
-            key, subkey = jax.random.split(key, 2)
-            train_data = generate_train_data(args, subkey)
+        (params, state, _, best, best_params), metrics = train_steps(params, state, None, best, best_params, e-args.fuse_steps+1)
+        loss = metrics['loss'][-1]
 
-        if args.model == 'spinn':
-            loss, gradient = apply_model_spinn(apply_fn, params, *train_data)
-        elif args.model == 'pinn':
-            loss, gradient = apply_model_pinn(apply_fn, params, *train_data)
-        params, state = update_model(optim, gradient, params, state)
-
-        if e % 10 == 0:
-            if loss < best:
-                best = loss
-                best_error = eval_fn(apply_fn, params, *test_data)
+        if metrics['improved']:
+            # save the best error when the loss value is lowest
+            best_error = eval_fn(apply_fn, best_params, *test_data)
 
         # log
-        if e % args.log_iter == 0:
+        if chunk_hits(e, args.fuse_steps, args.log_iter):
             error = eval_fn(apply_fn, params, *test_data)
             print(f'Epoch: {e}/{args.epochs} --> total loss: {loss:.8f}, error: {error:.8f}, best error {best_error:.8f}')
             with open(os.path.join(result_dir, 'log (loss, error).csv'), 'a') as f:
                 f.write(f'{loss}, {error}, {best_error}\n')
 
+        # checkpoint
+        if chunk_hits(e, args.fuse_steps, args.ckpt_iter):
+            writer.save(checkpoint(e))
+
     # training done
+    writer.save(checkpoint(args.epochs))
+    writer.close()
     runtime = time.time() - start
-    print(f'Runtime --> total: {runtime:.2f}sec ({(runtime/(args.epochs-1)*1000):.2f}ms/iter.)')
-    jnp.save(os.path.join(result_dir, 'params.npy'), params)
+    print(f'Runtime --> total: {runtime:.2f}sec ({(runtime/max(args.epochs-e0-args.fuse_steps, 1)*1000):.2f}ms/iter.)')
+    save_tree(os.path.join(result_dir, 'params.npz'), params)
+    if args.model == 'spinn':
+        # per-axis factor tables of the best solution, for inference without Flax (utils/factor_tables.py)
+        export_factor_tables(os.path.join(result_dir, 'factor_tables.npz'), best_params, **spinn_layout(args))
         
     # save runtime
     runtime = np.array([runtime])
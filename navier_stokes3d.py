@@ -1,54 +1,48 @@
 import argparse
 import csv
+import multiprocessing
 import os
 import time
+from concurrent.futures import ProcessPoolExecutor
 
 import jax
 import numpy as np
 import optax
 from jax import jvp
+from networks.factorized_derivatives import FeatureCache
 from networks.hessian_vector_products import *
 from tqdm import trange
-from utils.data_generators import generate_test_data, generate_train_data
+from utils.checkpoints import CheckpointWriter, SnapshotWriter, load_tree, save_tree
+from utils.data_generators import generate_test_data, generate_train_data, make_offset_grids
 from utils.eval_functions import setup_eval_function
+from utils.factor_tables import export_factor_tables, spinn_layout
 from utils.training_utils import *
 from utils.visualizer import show_solution
-from utils.vorticity import velocity_to_vorticity_fwd
+from utils.vorticity import divergence, velocity_jacobian, velocity_vorticity
 
 os.environ["CUDA_VISIBLE_DEVICES"] = "0"
 os.environ["XLA_PYTHON_CLIENT_PREALLOCATE"] = "false"
 
 # loss function for navier stokes (SPINN)
-@partial(jax.jit, static_argnums=(0,))
-def apply_model_spinn(apply_fn, params, tc, xc, yc, ti, xi, yi, w0_gt, u0_gt, v0_gt, lbda_c, lbda_ic):
+@partial(jax.jit, static_argnums=(0,), static_argnames=('n_tiles', 'axis', 'mesh'))
+def apply_model_spinn(apply_fn, params, tc, xc, yc, ti, xi, yi, w0_gt, u0_gt, v0_gt, lbda_c, lbda_ic, n_tiles=1, axis=0, mesh=None):
     def residual_loss(params, t, x, y):
-        # compute [u, v]
-        uv = apply_fn(params, t, x, y)
+        # velocity [u, v], vorticity and their 1st derivatives along (t, x, y)
+        (uv, w), G = velocity_jacobian(
+            partial(velocity_vorticity, apply_fn),
+            params, t, x, y,
+            argnums=(0, 1, 2)
+        )
+        w_t, w_x, w_y = G[0][1], G[1][1], G[2][1]
 
-        vec_t = jnp.ones(t.shape)
         vec_xy = jnp.ones(x.shape)
-        w_t = jvp(
-            lambda t: velocity_to_vorticity_fwd(apply_fn, params, t, x, y), 
-            (t,), 
-            (vec_t,)
-        )[1]
-        w_x = jvp(
-            lambda x: velocity_to_vorticity_fwd(apply_fn, params, t, x, y), 
-            (x,), 
-            (vec_xy,)
-        )[1]
-        w_y = jvp(
-            lambda y: velocity_to_vorticity_fwd(apply_fn, params, t, x, y), 
-            (y,), 
-            (vec_xy,)
-        )[1]
         w_xx = hvp_fwdfwd(
-            lambda x: velocity_to_vorticity_fwd(apply_fn, params, t, x, y), 
+            lambda x: velocity_vorticity(apply_fn, params, t, x, y)[1], 
             (x,), 
             (vec_xy,)
         )
         w_yy = hvp_fwdfwd(
-            lambda y: velocity_to_vorticity_fwd(apply_fn, params, t, x, y), 
+            lambda y: velocity_vorticity(apply_fn, params, t, x, y)[1], 
             (y,), 
             (vec_xy,)
         )
@@ -56,17 +50,14 @@ def apply_model_spinn(apply_fn, params, tc, xc, yc, ti, xi, yi, w0_gt, u0_gt, v0
         R_w = w_t + uv[0]*w_x + uv[1]*w_y - 0.01*(w_xx + w_yy)
 
         # incompressible fluid constraint
-        u_x = jvp(lambda x: apply_fn(params, t, x, y)[0], (x,), (vec_xy,))[1]
-        v_y = jvp(lambda y: apply_fn(params, t, x, y)[1], (y,), (vec_xy,))[1]
-        R_c = u_x + v_y
+        R_c = divergence([G[1][0], G[2][0]])
 
         return jnp.mean(R_w**2) + lbda_c*jnp.mean(R_c**2)
 
     def initial_loss(params, ti, xi, yi, w0_gt, u0_gt, v0_gt):
         # use initial vorticity and velocity
-        w0 = velocity_to_vorticity_fwd(apply_fn, params, ti, xi, yi)
+        (u0, v0), w0 = velocity_vorticity(apply_fn, params, ti, xi, yi)
         R_ic_w = jnp.squeeze(w0) - w0_gt 
-        u0, v0 = apply_fn(params, ti, xi, yi)
         R_ic_u = jnp.squeeze(u0) - u0_gt
         R_ic_v = jnp.squeeze(v0) - v0_gt
         loss = jnp.mean(jnp.square(R_ic_w)) + jnp.mean(jnp.square(R_ic_u)) + jnp.mean(jnp.square(R_ic_v))
@@ -75,153 +66,332 @@ def apply_model_spinn(apply_fn, params, tc, xc, yc, ti, xi, yi, w0_gt, u0_gt, v0
 
     # loss function w.r.t learnable parameters
     # no boundary loss since we're using exact periodic b.c
-    loss_fn = lambda params: residual_loss(params, tc, xc, yc) + lbda_ic*initial_loss(params, ti, jnp.transpose(xi), jnp.transpose(yi), w0_gt, u0_gt, v0_gt)
+    loss_fn = lambda params: lbda_ic*initial_loss(params, ti, jnp.transpose(xi), jnp.transpose(yi), w0_gt, u0_gt, v0_gt)
     loss, gradient = jax.value_and_grad(loss_fn)(params)
 
+    # residual loss over the full grid, tile by tile (and device by device) along one grid axis
+    res_loss, res_gradient = tiled_value_and_grad(residual_loss, params, (tc, xc, yc), axis=axis, n_tiles=n_tiles, mesh=mesh)
+    loss, gradient = loss + res_loss, jax.tree_util.tree_map(jnp.add, gradient, res_gradient)
+
     return loss, gradient
 
 
-if __name__ == '__main__':
-    # config
-    parser = argparse.ArgumentParser(description='Training configurations')
+# networks, optimizer, eval function, offset grids and devices, set up once per process and
+# shared by every time window trained in it (as is the fused training step, compiled for the first)
+_shared = {}
 
-    # data directory
-    parser.add_argument('--data_dir', type=str, default='./data/navier_stokes', help='a directory to reference solution')
 
-    # model and equation
-    parser.add_argument('--model', type=str, default='spinn', choices=['spinn', 'pinn'], help='model name (pinn; spinn)')
-    parser.add_argument('--equation', type=str, default='navier_stokes3d', help='equation to solve')
-    
-    # input data settings
-    parser.add_argument('--nt', type=int, default=None, help='the number of time points for time axis')
-    parser.add_argument('--nxy', type=int, default=None, help='the number of points for each spatial axis')
+def setup_shared(args):
+    if not _shared:
+        # random key
+        key = jax.random.PRNGKey(args.seed)
 
-    # training settings
-    parser.add_argument('--seed', type=int, default=111, help='random seed')
-    parser.add_argument('--lr', type=float, default=2e-3, help='learning rate')
-    parser.add_argument('--epochs', type=int, default=100000, help='training epochs')
-    parser.add_argument('--offset_num', type=int, default=8, help='the number of offsets in training data')
-    parser.add_argument('--offset_iter', type=int, default=100, help='change offset every...')
-    parser.add_argument('--lbda_c', type=int, default=5000, help='weighting factor for incompressible condition')
-    parser.add_argument('--lbda_ic', type=int, default=10000, help='weighting factor for initial condition')
+        # make & init model forward function
+        key, subkey = jax.random.split(key, 2)
+        apply_fn, init_params = setup_networks(args, subkey)
 
-    # model settings
-    parser.add_argument('--mlp', type=str, default='modified_mlp', choices=['mlp', 'modified_mlp'], help='type of mlp')
-    parser.add_argument('--n_layers', type=int, default=3, help='the number of layer')
-    parser.add_argument('--features', type=int, default=128, help='feature size of each layer')
-    parser.add_argument('--r', type=int, default=128, help='rank of the approximated tensor')
-    parser.add_argument('--out_dim', type=int, default=2, help='size of model output')
-    parser.add_argument('--pos_enc', type=int, default=5, help='size of the positional encoding (zero if no encoding)')
+        # count total params
+        args.total_params = sum(x.size for x in jax.tree_util.tree_leaves(init_params))
 
-    # time marching
-    parser.add_argument('--marching_steps', type=int, default=10, help='step size for time marching')
-    parser.add_argument('--step_idx', type=int, default=0, help='step index for time marching')
+        # name model
+        name = name_model(args)
 
-    # log settings
-    parser.add_argument('--log_iter', type=int, default=1000, help='print log every...')
-    parser.add_argument('--plot_iter', type=int, default=50000, help='plot result every...')
+        # result dir
+        root_dir = os.path.join(os.getcwd(), 'results', args.equation, args.model)
 
-    args = parser.parse_args()
+        # optimizer
+        optim = optax.adam(learning_rate=args.lr)
+
+        # dataset key
+        key, data_key = jax.random.split(key, 2)
 
-    # random key
-    key = jax.random.PRNGKey(args.seed)
+        # loss & evaluation function
+        eval_fn = setup_eval_function(args.model, args.equation)
+        if args.aot:
+            eval_fn = aot(eval_fn, export_prefix(args, 'eval'), n_static=1)
 
-    # make & init model forward function
-    key, subkey = jax.random.split(key, 2)
-    apply_fn, params = setup_networks(args, subkey)
+        # offset grids of (tc, xc, yc), derived in the training step and switched every args.offset_iter epochs
+        # (drawn from the dataset key, as the stacked grids were)
+        offset_fn = make_offset_grids(args.offset_mode, args.offset_num, data_key)
 
-    # count total params
-    args.total_params = sum(x.size for x in jax.tree_util.tree_leaves(params))
+        # devices for data-parallel training, the residual grid is sharded along args.shard_axis
+        mesh = setup_mesh(args.devices)
 
-    # name model
-    name = name_model(args)
+        # queries of the visualization and the next ICs reuse the per-axis features (query_fn)
+        _shared.update(apply_fn=apply_fn, init_params=init_params, name=name, root_dir=root_dir, optim=optim,
+                       data_key=data_key, eval_fn=eval_fn, offset_fn=offset_fn, mesh=mesh, train_steps=None,
+                       ic_writer=SnapshotWriter(), query_fn=FeatureCache(apply_fn, args.out_dim) if args.model == 'spinn' else apply_fn)
+    return _shared
 
-    # result dir
-    root_dir = os.path.join(os.getcwd(), 'results', args.equation, args.model)
-    result_dir = os.path.join(root_dir, name, f'{args.step_idx}')
+
+# train time-marching window step_idx from IC ic (None: read from IC_pred/, or the data in the
+# first window); prev = (params, t0, loss level) of the previous window, warm-started from with
+# args.warm_start; coarse windows (the parareal predictor) train for args.coarse_epochs only,
+# log to coarse_{step_idx}/ and never write their IC
+# returns the IC predicted for the next window and this window's prev
+def train_window(args, step_idx, ic=None, prev=None, coarse=False):
+    s = setup_shared(args)
+    apply_fn, optim, eval_fn, root_dir, name = s['apply_fn'], s['optim'], s['eval_fn'], s['root_dir'], s['name']
+    epochs = args.coarse_epochs if coarse else args.epochs
+    write = args.save_ic and not coarse
+
+    args.step_idx = step_idx
+    result_dir = os.path.join(root_dir, name, f'coarse_{args.step_idx}' if coarse else f'{args.step_idx}')
 
     # make dir
     os.makedirs(result_dir, exist_ok=True)
 
-    # optimizer
-    optim = optax.adam(learning_rate=args.lr)
-    state = optim.init(params)
-
     # dataset
-    key, subkey = jax.random.split(key, 2)
-    train_data = generate_train_data(args, subkey, result_dir=result_dir)
-    test_data = generate_test_data(args, result_dir)
-
-    # loss & evaluation function
-    eval_fn = setup_eval_function(args.model, args.equation)
+    train_data = generate_train_data(args, s['data_key'], result_dir=result_dir, ic=ic)
+    test_data = generate_test_data(args, result_dir, ic=ic)
+
+    # every window starts from the same initialization, or warm-started from the previous
+    # window's solution, stopping once the loss is back at the level that window ended at
+    # (its best tracked loss)
+    target = None
+    if args.warm_start != 'none' and prev is not None:
+        prev_params, prev_t0, prev_loss = prev
+        params = warm_start_params(prev_params, args, args.warm_start, train_data[0][0, 0] - prev_t0)
+        if args.auto_epochs:
+            target = prev_loss
+    else:
+        params = s['init_params']
+    state = optim.init(params)
 
     # save training configuration
     save_config(args, result_dir)
 
+    # checkpoint of this window, continued from with --resume (log kept; not in parareal runs,
+    # where a window is trained again from a new IC, nor in coarse windows)
+    ckpt_path = os.path.join(result_dir, 'checkpoint.npz')
+    resume = args.resume and not args.parareal and not coarse and os.path.exists(ckpt_path)
+
     # log
-    logs = []
-    if os.path.exists(os.path.join(result_dir, 'log (loss, error).csv')):
+    if not resume and os.path.exists(os.path.join(result_dir, 'log (loss, error).csv')):
         os.remove(os.path.join(result_dir, 'log (loss, error).csv'))
     if os.path.exists(os.path.join(result_dir, '..', 'bset_error.csv')):
         os.remove(os.path.join(result_dir, '..', 'bset_error.csv'))
     best = 10000000.
-    
+
     # get data
-    tc_mult, xc_mult, yc_mult, ti, xi, yi, w0, u0, v0 = train_data
-    tc, xc, yc = tc_mult[0], xc_mult[0], yc_mult[0]
+    tc, xc, yc, ti, xi, yi, w0, u0, v0 = train_data
+
+    if s['train_steps'] is None:
+        mesh = s['mesh']
+        # split the residual grid into tiles that fit the memory cap
+        n_tiles = tiles_for_memory(apply_model_spinn, (apply_fn, params, tc, xc, yc, ti, xi, yi, w0, u0, v0, args.lbda_c, args.lbda_ic), (tc, xc, yc)[args.shard_axis].shape[0], args.mem_cap, axis=args.shard_axis, mesh=mesh)
+
+        # loss/gradient step, fused with the update over args.fuse_steps epochs
+        # (offset grids switched and best loss tracked on device)
+        step_fn = lambda apply_fn, params, *train_data: apply_model_spinn(apply_fn, params, *train_data, args.lbda_c, args.lbda_ic, n_tiles=n_tiles, axis=args.shard_axis, mesh=mesh)
+        if args.rank_devices > 1:
+            # rank axis of the body networks split over args.rank_devices devices
+            step_fn = rank_parallel(step_fn, args, params, setup_mesh(args.rank_devices, 'rank'))
+        else:
+            step_fn = partial(step_fn, apply_fn)
+        s['train_steps'] = make_train_steps(step_fn, optim, args.fuse_steps, best_every=100, best_from=args.epochs*0.7, offset_fn=s['offset_fn'], offset_iter=args.offset_iter, export=export_prefix(args, 'train'))
+    train_steps = s['train_steps']
+    best_params, best_error, tracked = params, None, False
+
+    # params, optimizer state, best loss and epoch, written in the background every
+    # args.ckpt_iter epochs
+    checkpoint = lambda e, loss: {'params': params, 'state': state, 'best': best, 'best_params': best_params, 'epoch': e, 'loss': loss}
+    writer, e0 = CheckpointWriter(ckpt_path), 0
+    if resume:
+        # same shapes and dtypes as a fresh start: the training step is still compiled once
+        ckpt = load_tree(ckpt_path, checkpoint(e0, 0.))
+        params, state, best, best_params = ckpt['params'], ckpt['state'], ckpt['best'], ckpt['best_params']
+        e0 = e = int(ckpt['epoch'])
+        loss = ckpt['loss']
+        tracked = bool(best < 10000000.)
+        if tracked:
+            best_error = eval_fn(apply_fn, best_params, *test_data)
+        print(f'Resuming window {args.step_idx} from epoch {e0}')
 
     # start training
-    for e in trange(1, args.epochs + 1):
-        if e == 2:
+    start, stopped = time.time(), False
+    for e in trange(e0 + args.fuse_steps, epochs + 1, args.fuse_steps):
+        if e == e0 + 2*args.fuse_steps:
             # exclude compiling time
             start = time.time()
 
-        if e % args.offset_iter == 0:
-            # change input
-            offset_idx = (e // args.offset_iter) % args.offset_num
-            tc, xc, yc = tc_mult[offset_idx], xc_mult[offset_idx], yc_mult[offset_idx]
+        (params, state, _, best, best_params), metrics = train_steps(params, state, None, best, best_params, e-args.fuse_steps+1, *train_data)
+        loss = metrics['loss'][-1]
 
-        loss, gradient = apply_model_spinn(apply_fn, params, tc, xc, yc, ti, xi, yi, w0, u0, v0, args.lbda_c, args.lbda_ic)
-        params, state = update_model(optim, gradient, params, state)
-
-        if e % 100 == 0 and e > args.epochs*0.7:
-            if loss < best:
-                best = loss
-                best_error = eval_fn(apply_fn, params, *test_data)
-                # save next IC prediction for time marching
-                save_next_IC(root_dir, name, apply_fn,params, test_data, args.step_idx, e)
+        if metrics['improved']:
+            # best params kept on device: their error is evaluated at the next log, and the next
+            # IC computed once, at the end of the window
+            tracked, best_error = True, None
 
         # log
-        if e % args.log_iter == 0:
+        if chunk_hits(e, args.fuse_steps, args.log_iter):
             error = eval_fn(apply_fn, params, *test_data)
             if e == args.log_iter:
                 best_error = error
+            elif best_error is None:
+                best_error = eval_fn(apply_fn, best_params, *test_data)
             if e <= args.epochs*0.7:
-                print(f'Epoch: {e}/{args.epochs} --> total loss: {loss:.8f}, error: {error:.8f}, step_idx: {args.step_idx}')
+                print(f'Epoch: {e}/{epochs} --> total loss: {loss:.8f}, error: {error:.8f}, step_idx: {args.step_idx}')
                 with open(os.path.join(result_dir, 'log (loss, error).csv'), 'a') as f:
                     f.write(f'{loss}, {error}\n')
             else:
-                print(f'Epoch: {e}/{args.epochs} --> total loss: {loss:.8f}, error: {error:.8f}, best error {best_error:.8f}, step_idx: {args.step_idx}')
+                print(f'Epoch: {e}/{epochs} --> total loss: {loss:.8f}, error: {error:.8f}, best error {best_error:.8f}, step_idx: {args.step_idx}')
                 with open(os.path.join(result_dir, 'log (loss, error).csv'), 'a') as f:
                     f.write(f'{loss}, {error}, {best_error}\n')
 
         # visualization
-        if e % args.plot_iter == 0:
-            show_solution(args, apply_fn, params, test_data, result_dir, e)
-
-
-    # training done
+        if chunk_hits(e, args.fuse_steps, args.plot_iter):
+            show_solution(args, s['query_fn'], params, test_data, result_dir, e)
+
+        # checkpoint
+        if not coarse and chunk_hits(e, args.fuse_steps, args.ckpt_iter):
+            writer.save(checkpoint(e, loss))
+
+        # epoch budget of a warm-started window used up
+        if target is not None and loss <= target:
+            stopped = True
+            break
+
+    if stopped or not tracked:
+        # the params that reached the target (or the last ones, when no best loss was tracked,
+        # as in coarse windows) are this window's solution
+        best_params = params
+        best_error = eval_fn(apply_fn, best_params, *test_data)
+        print(f'Epoch: {e}/{epochs} --> total loss: {loss:.8f}, best error {best_error:.8f}, step_idx: {args.step_idx}')
+        with open(os.path.join(result_dir, 'log (loss, error).csv'), 'a') as f:
+            f.write(f'{loss}, {best_error}, {best_error}\n')
+
+    # next window's IC from this window's solution, computed once (its .mat written in the background)
+    next_ic = save_next_IC(root_dir, name, s['query_fn'], best_params, test_data, args.step_idx, e, write=write, writer=s['ic_writer'])
+
+    # training done (a finished window is kept as done, also when stopped early)
+    if not coarse:
+        writer.save(checkpoint(epochs, loss))
+    writer.close()
     runtime = time.time() - start
-    print(f'Runtime --> total: {runtime:.2f}sec ({(runtime/(args.epochs-1)*1000):.2f}ms/iter.)')
-    jnp.save(os.path.join(result_dir, 'params.npy'), params)
+    timed = e - e0 - args.fuse_steps if e - e0 > args.fuse_steps else max(e - e0, 1)
+    print(f'Runtime --> total: {runtime:.2f}sec ({(runtime/timed*1000):.2f}ms/iter.)')
+    save_tree(os.path.join(result_dir, 'params.npz'), params)
+    if args.model == 'spinn':
+        # per-axis factor tables of the best solution, for inference without Flax (utils/factor_tables.py)
+        export_factor_tables(os.path.join(result_dir, 'factor_tables.npz'), best_params, **spinn_layout(args))
 
     # save runtime
     runtime = np.array([runtime])
     np.savetxt(os.path.join(result_dir, 'total runtime (sec).csv'), runtime, delimiter=',')
 
+    return next_ic, (best_params, train_data[0][0, 0], float(min(best, loss)))
+
+
+# parareal propagators (fine: a full window, coarse: the cheap predictor), the IC predicted
+# for the next window as numpy arrays, sent between processes
+def propagate(args, coarse, step_idx, ic):
+    next_ic = train_window(args, step_idx, ic, coarse=coarse)[0]
+    # the window's IC written before the worker reports it (a failed write raises here)
+    setup_shared(args)['ic_writer'].wait()
+    return {k: np.asarray(v) for k, v in next_ic.items()}
+
+
+if __name__ == '__main__':
+    # config
+    parser = argparse.ArgumentParser(description='Training configurations')
+
+    # data directory
+    parser.add_argument('--data_dir', type=str, default='./data/navier_stokes', help='a directory to reference solution')
+
+    # model and equation
+    parser.add_argument('--model', type=str, default='spinn', choices=['spinn', 'pinn'], help='model name (pinn; spinn)')
+    parser.add_argument('--equation', type=str, default='navier_stokes3d', help='equation to solve')
+    
+    # input data settings
+    parser.add_argument('--nt', type=int, default=None, help='the number of time points for time axis')
+    parser.add_argument('--nxy', type=int, default=None, help='the number of points for each spatial axis')
+
+    # training settings
+    parser.add_argument('--seed', type=int, default=111, help='random seed')
+    parser.add_argument('--lr', type=float, default=2e-3, help='learning rate')
+    parser.add_argument('--epochs', type=int, default=100000, help='training epochs')
+    parser.add_argument('--fuse_steps', type=int, default=10, help='training epochs fused into one compiled step')
+    parser.add_argument('--cache_dir', type=str, default='./results/jax_cache', help='persistent compilation cache (empty: off)')
+    parser.add_argument('--aot', type=int, default=0, help='run the training step and eval function from ahead-of-time exports in cache_dir, exported by the first run')
+    parser.add_argument('--ckpt_iter', type=int, default=10000, help='checkpoint params, optimizer state and best loss of each window every...')
+    parser.add_argument('--devices', type=int, default=1, help='the number of devices for data-parallel training (zero for all devices)')
+    parser.add_argument('--shard_axis', type=int, default=0, help='grid axis sharded across devices (and split into tiles)')
+    parser.add_argument('--offset_num', type=int, default=8, help='the number of offsets in training data (zero for a new offset every time)')
+    parser.add_argument('--offset_mode', type=str, default='random', choices=['random', 'stratified', 'halton'], help='offset sequence (random; stratified; halton)')
+    parser.add_argument('--offset_iter', type=int, default=100, help='change offset every...')
+    parser.add_argument('--lbda_c', type=int, default=5000, help='weighting factor for incompressible condition')
+    parser.add_argument('--lbda_ic', type=int, default=10000, help='weighting factor for initial condition')
+
+    # model settings
+    parser.add_argument('--mlp', type=str, default='modified_mlp', choices=['mlp', 'modified_mlp'], help='type of mlp')
+    parser.add_argument('--n_layers', type=int, default=3, help='the number of layer')
+    parser.add_argument('--features', type=int, default=128, help='feature size of each layer')
+    parser.add_argument('--r', type=int, default=128, help='rank of the approximated tensor')
+    parser.add_argument('--rank_devices', type=int, default=1, help='the number of devices the rank axis of the body networks is split over')
+    parser.add_argument('--contraction', type=str, default='streamed', choices=['batched', 'streamed'], help='merge of per-axis features (batched: single einsum; streamed: never builds the rank-expanded intermediate)')
+    parser.add_argument('--mem_cap', type=float, default=0, help='memory cap (MB) for the residual loss, split into tiles above it (zero if no cap)')
+    parser.add_argument('--out_dim', type=int, default=2, help='size of model output')
+    parser.add_argument('--pos_enc', type=int, default=5, help='size of the positional encoding (zero if no encoding)')
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'], help='dtype policy of the networks (fp32; bf16: bf16 body networks, fp32 contraction and derivatives)')
+
+    # time marching
+    parser.add_argument('--marching_steps', type=int, default=10, help='step size for time marching')
+    parser.add_argument('--step_idx', type=int, default=0, help='step index for time marching')
+    parser.add_argument('--march', type=int, default=0, help='run windows step_idx, ..., marching_steps-1 in this process, compiled steps reused and ICs passed on in memory (zero: window step_idx only)')
+    parser.add_argument('--save_ic', type=int, default=1, help='write each next IC to IC_pred/ (needed when windows run as separate processes)')
+    parser.add_argument('--warm_start', type=str, default='none', choices=['none', 'continue', 'shift'], help='with --march, start each window from the previous one (none: fresh init; continue: previous params, continuous with the new IC; shift: temporal body network translated to the new window, repeating the previous window from its IC, not the new one)')
+    parser.add_argument('--auto_epochs', type=int, default=1, help='warm-started windows stop once their loss reaches the best loss of the previous window (epochs at most)')
+    parser.add_argument('--resume', type=int, default=0, help='continue each window from the checkpoint in its result directory, if there is one (a finished window is not trained again)')
+    parser.add_argument('--parareal', type=int, default=0, help='train windows step_idx, ..., marching_steps-1 at once in a process pool, for at most this many parareal iterations (zero: off)')
+    parser.add_argument('--parareal_tol', type=float, default=1e-3, help='parareal stops once no IC changes by more than this (relative l2)')
+    parser.add_argument('--coarse_epochs', type=int, default=5000, help='training epochs of the coarse windows predicting the parareal ICs')
+    parser.add_argument('--workers', type=int, default=0, help='worker processes of the parareal pool (zero: one per window, at most one per core)')
+
+    # log settings
+    parser.add_argument('--log_iter', type=int, default=1000, help='print log every...')
+    parser.add_argument('--plot_iter', type=int, default=50000, help='plot result every...')
+
+    args = parser.parse_args()
+    # training runs in whole chunks of fuse_steps epochs
+    if args.epochs % args.fuse_steps != 0:
+        parser.error(f'--epochs ({args.epochs}) must be a multiple of --fuse_steps ({args.fuse_steps})')
+    if args.parareal and args.coarse_epochs % args.fuse_steps != 0:
+        parser.error(f'--coarse_epochs ({args.coarse_epochs}) must be a multiple of --fuse_steps ({args.fuse_steps})')
+    # warm starts pass the previous window's params on in memory, which only --march does
+    if args.warm_start != 'none' and (not args.march or args.parareal):
+        parser.error('--warm_start needs --march (and not --parareal)')
+    # the rank axis is split over a mesh of its own (r evenly), not combined with data-parallel devices
+    if args.rank_devices > 1 and args.devices != 1:
+        parser.error('--rank_devices cannot be combined with data-parallel --devices')
+    if args.rank_devices > jax.device_count():
+        parser.error(f'--rank_devices ({args.rank_devices}) is more than the {jax.device_count()} devices available')
+    if args.r % args.rank_devices != 0:
+        parser.error(f'--r ({args.r}) must be a multiple of --rank_devices ({args.rank_devices})')
+
+    s = setup_shared(args)
+    root_dir, name = s['root_dir'], s['name']
+    last_idx = args.marching_steps - 1 if args.march or args.parareal else args.step_idx
+    windows = range(args.step_idx, last_idx + 1)
+    if args.parareal:
+        # every window trained at once, one per worker process, from ICs predicted by the coarse
+        # windows and corrected from the neighbouring windows' predictions until they converge
+        workers = args.workers or min(len(windows), os.cpu_count())
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            parareal(partial(propagate, args, False), partial(propagate, args, True), windows, pool, args.parareal, args.parareal_tol)
+    else:
+        # time windows trained in this process; every window has the same array shapes, so the
+        # fused training step and eval kernels compiled for the first one are reused by the rest,
+        # and each window's IC is the previous window's prediction passed on in memory
+        ic, prev = None, None
+        for step_idx in windows:
+            ic, prev = train_window(args, step_idx, ic, prev)
+    # every IC written (a failed write raises here)
+    s['ic_writer'].close()
+
     # save total error
     error_list = [0]*args.marching_steps
-    if args.step_idx == args.marching_steps-1:
+    if last_idx == args.marching_steps-1:
         for i in range(args.marching_steps):
             with open(os.path.join(root_dir, name, f'{i}', 'log (loss, error).csv'), 'r') as f:
                 reader = csv.reader(f, delimiter=' ')
@@ -229,6 +399,6 @@ if __name__ == '__main__':
                     error_list[i] = float(row[-1])
 
         final_error = sum(error_list)/len(error_list)
-        with open(os.path.join(result_dir, '..', 'best_error.csv'), 'a') as f:
+        with open(os.path.join(root_dir, name, 'best_error.csv'), 'a') as f:
             f.write(f'test error for each time window: {error_list}\n')
-            f.write(f'total error: {final_error}\n')
\ No newline at end of file
+            f.write(f'total error: {final_error}\n')
@@ -5,106 +5,105 @@ import time
 import jax
 import numpy as np
 import optax
+from networks.factorized_derivatives import FeatureCache, axis_derivatives, contract, face_derivatives
 from networks.hessian_vector_products import *
 from tqdm import trange
-from utils.data_generators import generate_test_data, generate_train_data
+from utils.checkpoints import CheckpointWriter, load_tree, save_tree
+from utils.data_generators import TrainSampler, generate_test_data
+from utils.data_utils import attach_factors, detach_factors
 from utils.eval_functions import setup_eval_function
+from utils.factor_tables import export_factor_tables, spinn_layout
 from utils.training_utils import *
-from utils.vorticity import vorx, vory, vorz
+from utils.vorticity import advection, divergence, velocity_vorticity
 from utils.visualizer import show_solution
 
 
-@partial(jax.jit, static_argnums=(0,))
-def apply_model_spinn(apply_fn, params, nu, lbda_c, lbda_ic, *train_data):
-    def residual_loss(params, t, x, y, z, f):
-        # calculate u
-        ux, uy, uz = apply_fn(params, t, x, y, z)
-        # pdb.set_trace()
-        # calculate w (3D vorticity vector)
-        wx = vorx(apply_fn, params, t, x, y, z)
-        wy = vory(apply_fn, params, t, x, y, z)
-        wz = vorz(apply_fn, params, t, x, y, z)
-        # tangent vector dx/dx
-        # assumes t, x, y have same shape (very important)
-        vec = jnp.ones(t.shape)
-
-        # x-component
-        wx_t = jvp(lambda t: vorx(apply_fn, params, t, x, y, z), (t,), (vec,))[1]
-        wx_x, wx_xx = hvp_fwdfwd(lambda x: vorx(apply_fn, params, t, x, y, z), (x,), (vec,), True)
-        wx_y, wx_yy = hvp_fwdfwd(lambda y: vorx(apply_fn, params, t, x, y, z), (y,), (vec,), True)
-        wx_z, wx_zz = hvp_fwdfwd(lambda z: vorx(apply_fn, params, t, x, y, z), (z,), (vec,), True)
-        
-        ux_x = jvp(lambda x: apply_fn(params, t, x, y, z)[0], (x,), (vec,))[1]
-        ux_y = jvp(lambda y: apply_fn(params, t, x, y, z)[0], (y,), (vec,))[1]
-        ux_z = jvp(lambda z: apply_fn(params, t, x, y, z)[0], (z,), (vec,))[1]
-
-        loss_x = jnp.mean((wx_t + ux*wx_x + uy*wx_y + uz*wx_z - \
-             (wx*ux_x + wy*ux_y + wz*ux_z) - \
-                nu*(wx_xx + wx_yy + wx_zz) - \
-                    f[0])**2)
-
-        # y-component
-        wy_t = jvp(lambda t: vory(apply_fn, params, t, x, y, z), (t,), (vec,))[1]
-        wy_x, wy_xx = hvp_fwdfwd(lambda x: vory(apply_fn, params, t, x, y, z), (x,), (vec,), True)
-        wy_y, wy_yy = hvp_fwdfwd(lambda y: vory(apply_fn, params, t, x, y, z), (y,), (vec,), True)
-        wy_z, wy_zz = hvp_fwdfwd(lambda z: vory(apply_fn, params, t, x, y, z), (z,), (vec,), True)
-        
-        uy_x = jvp(lambda x: apply_fn(params, t, x, y, z)[1], (x,), (vec,))[1]
-        uy_y = jvp(lambda y: apply_fn(params, t, x, y, z)[1], (y,), (vec,))[1]
-        uy_z = jvp(lambda z: apply_fn(params, t, x, y, z)[1], (z,), (vec,))[1]
-
-        loss_y = jnp.mean((wy_t + ux*wy_x + uy*wy_y + uz*wy_z - \
-             (wx*uy_x + wy*uy_y + wz*uy_z) - \
-                nu*(wy_xx + wy_yy + wy_zz) - \
-                    f[1])**2)
-
-        # z-component
-        wz_t = jvp(lambda t: vorz(apply_fn, params, t, x, y, z), (t,), (vec,))[1]
-        wz_x, wz_xx = hvp_fwdfwd(lambda x: vorz(apply_fn, params, t, x, y, z), (x,), (vec,), True)
-        wz_y, wz_yy = hvp_fwdfwd(lambda y: vorz(apply_fn, params, t, x, y, z), (y,), (vec,), True)
-        wz_z, wz_zz = hvp_fwdfwd(lambda z: vorz(apply_fn, params, t, x, y, z), (z,), (vec,), True)
-        
-        uz_x = jvp(lambda x: apply_fn(params, t, x, y, z)[2], (x,), (vec,))[1]
-        uz_y = jvp(lambda y: apply_fn(params, t, x, y, z)[2], (y,), (vec,))[1]
-        uz_z = jvp(lambda z: apply_fn(params, t, x, y, z)[2], (z,), (vec,))[1]
+# velocity components differentiated by 'orders' along (t, x, y, z), from per-axis feature tables
+def table_velocity(tables, *orders, channel=None):
+    return contract(tables, tuple(map(sum, zip(*orders))), 3, channel)
+
+
+# w = curl u (differentiated by 'orders'), from per-axis feature tables
+def table_vorticity(tables, *orders):
+    D = partial(table_velocity, tables)
+    e_x, e_y, e_z = (0, 1, 0, 0), (0, 0, 1, 0), (0, 0, 0, 1)
+    wx = D(e_y, *orders, channel=2) - D(e_z, *orders, channel=1)
+    wy = D(e_z, *orders, channel=0) - D(e_x, *orders, channel=2)
+    wz = D(e_x, *orders, channel=1) - D(e_y, *orders, channel=0)
+    return wx, wy, wz
+
+
+# squared residual at each point of the (t, x, y, z) collocation grid (SPINN),
+# vorticity transport of every component plus the weighted incompressibility
+def residual_spinn(apply_fn, params, nu, lbda_c, t, x, y, z, f):
+    # per-axis features and their derivatives up to 3rd order (one taylor
+    # propagation), shared by every velocity component and partial below
+    tables = axis_derivatives(apply_fn, params, t, x, y, z, order=3)
+    D, vorticity = partial(table_velocity, tables), partial(table_vorticity, tables)
+    e_0, e_t, e_x, e_y, e_z = (0, 0, 0, 0), (1, 0, 0, 0), (0, 1, 0, 0), (0, 0, 1, 0), (0, 0, 0, 1)
+
+    # calculate u, w (3D vorticity vector)
+    u, w = D(e_0), vorticity(e_0)
+    u_x, u_y, u_z = D(e_x), D(e_y), D(e_z)
+    w_t = vorticity(e_t)
+    w_x, w_xx = vorticity(e_x), vorticity(e_x, e_x)
+    w_y, w_yy = vorticity(e_y), vorticity(e_y, e_y)
+    w_z, w_zz = vorticity(e_z), vorticity(e_z, e_z)
+
+    # convective and vortex stretching terms (u_x[i] = d(u_i)/dx)
+    conv = advection(u, (w_x, w_y, w_z))
+    stretch = advection(w, (u_x, u_y, u_z))
 
-        loss_z = jnp.mean((wz_t + ux*wz_x + uy*wz_y + uz*wz_z - \
-             (wx*uz_x + wy*uz_y + wz*uz_z) - \
-                nu*(wz_xx + wz_yy + wz_zz) - \
-                    f[2])**2)
+    R = 0.
+    for i in range(3):
+        R += (w_t[i] + conv[i] - stretch[i] - \
+            nu*(w_xx[i] + w_yy[i] + w_zz[i]) - \
+                f[i])**2
 
-        loss_c = jnp.mean((ux_x + uy_y + uz_z)**2)
+    return R + lbda_c*divergence((u_x, u_y, u_z))**2
 
-        return loss_x + loss_y + loss_z + lbda_c*loss_c
+
+# squared residual over the full collocation grid, tile by tile (and device by device),
+# the forcing term contracted from its per-axis factor tables one tile at a time
+def residual_grid(apply_fn, params, nu, lbda_c, *train_data, n_tiles=1, axis=0, mesh=None):
+    tc, xc, yc, zc, fc = train_data[:5]
+    fn = lambda *axes: residual_spinn(apply_fn, params, nu, lbda_c, *detach_factors(axes))
+    return tiled_map(fn, attach_factors((tc, xc, yc, zc), fc), axis=axis, n_tiles=n_tiles, mesh=mesh)
+
+
+@partial(jax.jit, static_argnums=(0,), static_argnames=('n_tiles', 'axis', 'mesh'))
+def apply_model_spinn(apply_fn, params, nu, lbda_c, lbda_ic, *train_data, n_tiles=1, axis=0, mesh=None):
+    def residual_loss(params, *axes):
+        return jnp.mean(residual_spinn(apply_fn, params, nu, lbda_c, *detach_factors(axes)))
 
     def initial_loss(params, t, x, y, z, w, u):
-        ux, uy, uz = apply_fn(params, t, x, y, z)
-        wx = vorx(apply_fn, params, t, x, y, z)
-        wy = vory(apply_fn, params, t, x, y, z)
-        wz = vorz(apply_fn, params, t, x, y, z)
+        (ux, uy, uz), (wx, wy, wz) = velocity_vorticity(apply_fn, params, t, x, y, z)
         loss = jnp.mean((wx - w[0])**2) + jnp.mean((wy - w[1])**2) + jnp.mean((wz - w[2])**2)
         loss += jnp.mean((ux - u[0])**2) + jnp.mean((uy - u[1])**2) + jnp.mean((uz - u[2])**2)
         return loss
 
     def boundary_loss(params, t, x, y, z, w):
+        # every face (and its 1st derivatives) from one evaluation of the body networks
         loss = 0.
-        for i in range(6):
-            wx = vorx(apply_fn, params, t[i], x[i], y[i], z[i])
-            wy = vory(apply_fn, params, t[i], x[i], y[i], z[i])
-            wz = vorz(apply_fn, params, t[i], x[i], y[i], z[i])
-            loss += (1/6.) * jnp.mean((wx - w[i][0])**2) + jnp.mean((wy - w[i][1])**2) + jnp.mean((wz - w[i][2])**2)
+        for tables, w_face in zip(face_derivatives(apply_fn, params, t, x, y, z, order=1), w):
+            wx, wy, wz = table_vorticity(tables, (0, 0, 0, 0))
+            loss += (1/6.) * jnp.mean((wx - w_face[0])**2) + jnp.mean((wy - w_face[1])**2) + jnp.mean((wz - w_face[2])**2)
         return loss
 
     # unpack data
     tc, xc, yc, zc, fc, ti, xi, yi, zi, wi, ui, tb, xb, yb, zb, wb = train_data
 
     # isolate loss func from redundant arguments
-    loss_fn = lambda params: residual_loss(params, tc, xc, yc, zc, fc) + \
-                        lbda_ic*initial_loss(params, ti, xi, yi, zi, wi, ui) + \
+    loss_fn = lambda params: lbda_ic*initial_loss(params, ti, xi, yi, zi, wi, ui) + \
                         boundary_loss(params, tb, xb, yb, zb, wb)
 
     loss, gradient = jax.value_and_grad(loss_fn)(params)
 
+    # residual loss over the full grid, tile by tile (and device by device) along one grid axis
+    # (forcing term contracted from its per-axis factor tables within each tile)
+    res_loss, res_gradient = tiled_value_and_grad(residual_loss, params, attach_factors((tc, xc, yc, zc), fc), axis=axis, n_tiles=n_tiles, mesh=mesh)
+    loss, gradient = loss + res_loss, jax.tree_util.tree_map(jnp.add, gradient, res_gradient)
+
     return loss, gradient
 
 
@@ -125,11 +124,23 @@ if __name__ == '__main__':
     parser.add_argument('--seed', type=int, default=111, help='random seed')
     parser.add_argument('--lr', type=float, default=1e-3, help='learning rate')
     parser.add_argument('--epochs', type=int, default=50000, help='training epochs')
+    parser.add_argument('--fuse_steps', type=int, default=10, help='training epochs fused into one compiled step')
+    parser.add_argument('--cache_dir', type=str, default='./results/jax_cache', help='persistent compilation cache (empty: off)')
+    parser.add_argument('--aot', type=int, default=0, help='run the training step and eval function from ahead-of-time exports in cache_dir, exported by the first run')
+    parser.add_argument('--ckpt_iter', type=int, default=10000, help='checkpoint params, optimizer state and sampler every...')
+    parser.add_argument('--resume', type=int, default=0, help='continue from the checkpoint in the result directory, if there is one')
+    parser.add_argument('--resample_iter', type=int, default=100, help='resample training data every...')
+    parser.add_argument('--sampling', type=str, default='uniform', choices=['uniform', 'residual'], help='collocation sampling of spinn (uniform; residual: per-axis densities from the residual marginals)')
+    parser.add_argument('--devices', type=int, default=1, help='the number of devices for data-parallel training (zero for all devices)')
+    parser.add_argument('--shard_axis', type=int, default=0, help='grid axis sharded across devices (and split into tiles)')
     parser.add_argument('--mlp', type=str, default='modified_mlp', help='type of mlp')
     parser.add_argument('--n_layers', type=int, default=5, help='the number of layer')
     parser.add_argument('--features', type=int, default=64, help='feature size of each layer')
     parser.add_argument('--r', type=int, default=128, help='rank of a approximated tensor')
+    parser.add_argument('--contraction', type=str, default='batched', choices=['batched', 'streamed'], help='merge of per-axis features (batched: single einsum; streamed: never builds the rank-expanded intermediate)')
+    parser.add_argument('--mem_cap', type=float, default=0, help='memory cap (MB) for the residual loss, split into tiles above it (zero if no cap)')
     parser.add_argument('--out_dim', type=int, default=3, help='size of model output')
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'], help='dtype policy of the networks (fp32; bf16: bf16 body networks, fp32 contraction and derivatives)')
     parser.add_argument('--nu', type=float, default=0.05, help='viscosity')
     parser.add_argument('--lbda_c', type=int, default=100, help='None')
     parser.add_argument('--lbda_ic', type=int, default=10, help='None')
@@ -139,6 +150,9 @@ if __name__ == '__main__':
     parser.add_argument('--plot_iter', type=int, default=10000, help='plot result every...')
 
     args = parser.parse_args()
+    # training runs in whole chunks of fuse_steps epochs
+    if args.epochs % args.fuse_steps != 0:
+        parser.error(f'--epochs ({args.epochs}) must be a multiple of --fuse_steps ({args.fuse_steps})')
 
     # random key
     key = jax.random.PRNGKey(args.seed)
@@ -146,6 +160,8 @@ if __name__ == '__main__':
     # make & init model forward function
     key, subkey = jax.random.split(key, 2)
     apply_fn, params = setup_networks(args, subkey)
+    # repeated visualization queries reuse the per-axis features
+    query_fn = FeatureCache(apply_fn, args.out_dim) if args.model == 'spinn' else apply_fn
 
     # count total params
     args.total_params = sum(x.size for x in jax.tree_util.tree_leaves(params))
@@ -166,18 +182,35 @@ if __name__ == '__main__':
 
     # dataset
     key, subkey = jax.random.split(key, 2)
-    train_data = generate_train_data(args, subkey)
+    # (kept on device and resampled within the training step every args.resample_iter epochs)
+    sampler = TrainSampler(args, subkey, args.resample_iter)
+    train_data = sampler.data
     test_data = generate_test_data(args, result_dir)
 
     # evaluation function
     eval_fn = setup_eval_function(args.model, args.equation)
+    if args.aot:
+        eval_fn = aot(eval_fn, export_prefix(args, 'eval'), n_static=1)
+
+    # devices for data-parallel training, the residual grid is sharded along args.shard_axis
+    mesh = setup_mesh(args.devices)
+
+    # split the residual grid into tiles that fit the memory cap
+    n_tiles = tiles_for_memory(apply_model_spinn, (apply_fn, params, args.nu, args.lbda_c, args.lbda_ic, *train_data), train_data[args.shard_axis].shape[0], args.mem_cap, axis=args.shard_axis, mesh=mesh)
+    if args.sampling == 'residual':
+        # collocation axes of each new batch drawn from the per-axis residual marginals
+        sampler.residual_fn = lambda params, *data: residual_grid(apply_fn, params, args.nu, args.lbda_c, *data, n_tiles=n_tiles, axis=args.shard_axis, mesh=mesh)
 
     # save training configuration
     save_config(args, result_dir)
 
+    # checkpoint of this run, continued from with --resume (log kept)
+    ckpt_path = os.path.join(result_dir, 'checkpoint.npz')
+    resume = args.resume and os.path.exists(ckpt_path)
+
     # log
     logs = []
-    if os.path.exists(os.path.join(result_dir, 'log (loss, error).csv')):
+    if not resume and os.path.exists(os.path.join(result_dir, 'log (loss, error).csv')):
         os.remove(os.path.join(result_dir, 'log (loss, error).csv'))
     if os.path.exists(os.path.join(result_dir, 'best_error.csv')):
         os.remove(os.path.join(result_dir, 'best_error.csv'))
@@ -185,39 +218,61 @@ if __name__ == '__main__':
 
     print("compiling...")
 
+    # loss/gradient step, fused with the update over args.fuse_steps epochs
+    step_fn = lambda params, *train_data: apply_model_spinn(apply_fn, params, args.nu, args.lbda_c, args.lbda_ic, *train_data, n_tiles=n_tiles, axis=args.shard_axis, mesh=mesh)
+    train_steps = make_train_steps(step_fn, optim, args.fuse_steps, best_every=10, sampler=sampler, export=export_prefix(args, 'train'))
+    best_params = params
+
+    # params, optimizer state, best loss, epoch and sampler (key and current batch), written in
+    # the background every args.ckpt_iter epochs
+    checkpoint = lambda e: {'params': params, 'state': state, 'best': best, 'best_params': best_params, 'epoch': e, 'key': sampler.key, 'data': sampler.data}
+    writer, e0 = CheckpointWriter(ckpt_path), 0
+    if resume:
+        # same shapes and dtypes as a fresh start: the training step is still compiled once
+        ckpt = load_tree(ckpt_path, checkpoint(e0))
+        params, state, best, best_params, e0 = ckpt['params'], ckpt['state'], ckpt['best'], ckpt['best_params'], int(ckpt['epoch'])
+        sampler.key, sampler.data = ckpt['key'], ckpt['data']
+        best_error = eval_fn(apply_fn, best_params, *test_data)
+        print(f'Resuming from epoch {e0}')
+
     # start training
-    for e in trange(1, args.epochs + 1):
-        if e == 2:
+    start = time.time()
+    for e in trange(e0 + args.fuse_steps, args.epochs + 1, args.fuse_steps):
+        if e == e0 + 2*args.fuse_steps:
             # exclude compiling time
             start = time.time()
-        if e % 100 == 0:
-            # sample new input data
-            key, subkey = jax.random.split(key, 2)
-            train_data = generate_train_data(args, subkey)
 
-        loss, gradient = apply_model_spinn(apply_fn, params, args.nu, args.lbda_c, args.lbda_ic, *train_data)
-        params, state = update_model(optim, gradient, params, state)
+        (params, state, _, best, best_params), metrics = train_steps(params, state, None, best, best_params, e-args.fuse_steps+1)
+        loss = metrics['loss'][-1]
 
-        if e % 10 == 0:
-            if loss < best:
-                best = loss
-                best_error = eval_fn(apply_fn, params, *test_data)
+        if metrics['improved']:
+            # save the best error when the loss value is lowest
+            best_error = eval_fn(apply_fn, best_params, *test_data)
 
         # log
-        if e % args.log_iter == 0:
+        if chunk_hits(e, args.fuse_steps, args.log_iter):
             error = eval_fn(apply_fn, params, *test_data)
             print(f'Epoch: {e}/{args.epochs} --> total loss: {loss:.8f}, error: {error:.8f}, best error {best_error:.8f}')
             with open(os.path.join(result_dir, 'log (loss, error).csv'), 'a') as f:
                 f.write(f'{loss}, {error}, {best_error}\n')
 
         # visualization
-        if e % args.plot_iter == 0:
-            show_solution(args, apply_fn, params, test_data, result_dir, e)
+        if chunk_hits(e, args.fuse_steps, args.plot_iter):
+            show_solution(args, query_fn, params, test_data, result_dir, e)
+
+        # checkpoint
+        if chunk_hits(e, args.fuse_steps, args.ckpt_iter):
+            writer.save(checkpoint(e))
 
     # training done
+    writer.save(checkpoint(args.epochs))
+    writer.close()
     runtime = time.time() - start
-    print(f'Runtime --> total: {runtime:.2f}sec ({(runtime/(args.epochs-1)*1000):.2f}ms/iter.)')
-    jnp.save(os.path.join(result_dir, 'params.npy'), params)
+    print(f'Runtime --> total: {runtime:.2f}sec ({(runtime/max(args.epochs-e0-args.fuse_steps, 1)*1000):.2f}ms/iter.)')
+    save_tree(os.path.join(result_dir, 'params.npz'), params)
+    if args.model == 'spinn':
+        # per-axis factor tables of the best solution, for inference without Flax (utils/factor_tables.py)
+        export_factor_tables(os.path.join(result_dir, 'factor_tables.npz'), best_params, **spinn_layout(args))
         
     # save runtime
     runtime = np.array([runtime])
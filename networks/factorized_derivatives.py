@@ -0,0 +1,129 @@
+import hashlib
+from collections import OrderedDict
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+from networks.hessian_vector_products import taylor_series
+from networks.physics_informed_neural_networks import contract_features
+
+
+# feature output of each body network (r*out_dim x n per axis)
+def axis_features(apply_fn, params, *inputs):
+    return apply_fn(params, *inputs, method='axis_features')
+
+
+# per-axis features and their derivatives up to 'order' (one taylor propagation)
+# each body network only sees its own 1-d input, so a single tangent of ones
+# on every input gives d^k(feature_i)/d(input_i)^k for all axes at once
+# tables[k][i]: k-th derivative of the i-th axis features
+def axis_derivatives(apply_fn, params, *inputs, order=2):
+    f = lambda *inputs: axis_features(apply_fn, params, *inputs)
+    if order == 0:
+        return [f(*inputs)]
+    vec = [jnp.ones(X.shape) for X in inputs]
+    return taylor_series(f, inputs, vec, order)
+
+
+# per-axis tables (as axis_derivatives) on every face of a boundary, from a single
+# evaluation of the body networks over the inputs of all faces packed along each axis
+# faces: one list of inputs per axis, entry j belonging to face j
+# face_tables[j][k][i]: k-th derivative of the i-th axis features on face j
+def face_derivatives(apply_fn, params, *faces, order=0):
+    bounds = [np.cumsum([0] + [X.shape[0] for X in axis]) for axis in faces]
+    tables = axis_derivatives(apply_fn, params, *[jnp.concatenate(axis) for axis in faces], order=order)
+    return [
+        [[T[i][:, b[j]:b[j+1]] for i, b in enumerate(bounds)] for T in tables]
+        for j in range(len(faces[0]))
+    ]
+
+
+# contract per-axis tables into the model output (or any of its partials)
+# orders: derivative order for each axis, e.g. (0, 2, 0) on (t, x, y) -> u_xx
+# channel: contract a single output component only
+def contract(tables, orders, out_dim=1, channel=None):
+    factors = [tables[k][i] for i, k in enumerate(orders)]
+    r = factors[0].shape[0] // out_dim
+    channels = range(out_dim) if channel is None else [channel]
+
+    pred = []
+    for i in channels:
+        pred += [_contract_factors([f[r*i:r*(i+1)] for f in factors])]
+
+    if len(pred) == 1:
+        # 1-dimensional output
+        return pred[0]
+    else:
+        # n-dimensional output
+        return pred
+
+
+# sum over rank of the outer product of (r x n_i) factors, as a single matmul
+# between the khatri-rao products of the leading and trailing halves
+def _contract_factors(factors):
+    shape = tuple(f.shape[1] for f in factors)
+    half = len(factors) // 2
+    lead, trail = factors[0], factors[half]
+    for f in factors[1:half]:
+        lead = (lead[:, :, None] * f[:, None, :]).reshape(lead.shape[0], -1)
+    for f in factors[half+1:]:
+        trail = (trail[:, :, None] * f[:, None, :]).reshape(trail.shape[0], -1)
+    return jnp.dot(lead.T, trail).reshape(shape)
+
+
+class FeatureCache:
+    '''
+    SPINN apply_fn with the per-axis body network outputs memoized, for repeated queries
+    (visualization, next ICs) on the same coordinates: only the axes whose inputs changed
+    are run again, e.g. a jvp along x reuses the t and y features
+    entries: features of one axis (and their first derivative, for the tangents of jvps
+    through the model), keyed on the params and the coordinates they were computed from,
+    least recently used evicted beyond max_entries
+    params or inputs being traced (jit, grad w.r.t. params) are evaluated without the cache
+    '''
+    def __init__(self, apply_fn, out_dim=1, max_entries=32):
+        self.apply_fn, self.out_dim, self.max_entries = apply_fn, out_dim, max_entries
+        self.entries = OrderedDict()
+
+    def __call__(self, params, *inputs):
+        if any(isinstance(leaf, jax.core.Tracer) for leaf in jax.tree_util.tree_leaves(params)):
+            return self.apply_fn(params, *inputs)
+        features = [self._axis_features(params, i, len(inputs))(X) for i, X in enumerate(inputs)]
+        return _contract_features_jit(features, features[0].shape[0] // self.out_dim, self.out_dim)
+
+    # features of axis i as a function of its own input, with a jvp from the cached derivative
+    # (each point only sees its own coordinate: the tangent is the derivative times the input's)
+    def _axis_features(self, params, i, n_axes):
+        f = jax.custom_jvp(lambda X: self._tables(params, i, n_axes, X, order=0)[0])
+        def f_jvp(primals, tangents):
+            F, dF = self._tables(params, i, n_axes, primals[0], order=1)
+            return F, dF * tangents[0].reshape(1, -1)
+        f.defjvp(f_jvp)
+        return f
+
+    # [features, derivative] of axis i up to 'order', from the cache when X is concrete
+    def _tables(self, params, i, n_axes, X, order):
+        if isinstance(X, jax.core.Tracer):
+            return self._compute(params, i, n_axes, X, order)
+        X = jnp.asarray(X)
+        # the entry keeps params alive, so their id is not reused while it is cached
+        key = (id(params), i, X.shape, X.dtype.name, hashlib.sha1(np.asarray(X).tobytes()).hexdigest())
+        if key in self.entries and len(self.entries[key][1]) > order:
+            self.entries.move_to_end(key)
+        else:
+            self.entries[key] = (params, self._compute(params, i, n_axes, X, order))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return self.entries[key][1]
+
+    # body network of axis i alone (a single dummy point on the other axes)
+    def _compute(self, params, i, n_axes, X, order):
+        dummy = jnp.zeros((1, 1), X.dtype)
+        f = lambda X: axis_features(self.apply_fn, params, *[X if j == i else dummy for j in range(n_axes)])[i]
+        if order == 0:
+            return [f(X)]
+        return list(jax.jvp(f, (X,), (jnp.ones(X.shape, X.dtype),)))
+
+
+# the models' contraction (einsum in the optimal order), compiled once per shape
+_contract_features_jit = jax.jit(contract_features, static_argnums=(1, 2))
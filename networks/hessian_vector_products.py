@@ -1,4 +1,7 @@
+import jax
+import jax.numpy as jnp
 from jax import jvp, vjp
+from jax.experimental.jet import jet
 
 
 # forward over forward
@@ -40,4 +43,16 @@ def hvp_revfwd(f, primals, tangents, return_primals=False):
     if return_primals:
         return primals_out, tangents_out
     else:
-        return tangents_out
\ No newline at end of file
+        return tangents_out
+
+
+# taylor-mode forward (jet): f and its derivatives up to 'order' along the
+# direction 'tangents' in a single propagation
+# returns [f, d1, ..., dk], each with the same structure as f's output
+def taylor_series(f, primals, tangents, order):
+    series = tuple([v] + [jnp.zeros(v.shape)]*(order-1) for v in tangents)
+    primals_out, series_out = jet(f, tuple(primals), series)
+    out_tree = jax.tree_util.tree_structure(primals_out)
+    series_out = out_tree.flatten_up_to(series_out)
+    return [primals_out] + [out_tree.unflatten([s[k] for s in series_out]) for k in range(order)]
+
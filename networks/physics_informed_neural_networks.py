@@ -1,6 +1,8 @@
 import pdb
-from typing import Sequence
+from functools import lru_cache, partial
+from typing import NamedTuple, Sequence
 
+import jax
 import jax.numpy as jnp
 from flax import linen as nn
 
@@ -38,24 +40,50 @@ class NS_exact(nn.Module):
 
 
 
+# dtypes of a precision policy
+# param: stored parameters (and so gradients and optimizer state)
+# compute: matmuls and activations of the body networks (with any derivative tangents
+#          propagated through them)
+# contract: rank contraction of the per-axis features into the model prediction
+# tangent: model outputs, per-axis features and their derivative tables as they leave the
+#          body networks (tables are contracted in this dtype by networks.factorized_derivatives)
+class Precision(NamedTuple):
+    param: str
+    compute: str
+    contract: str
+    tangent: str
+
+
+# 'bf16': bf16 body networks, everything downstream of them in fp32
+# (bf16 keeps the fp32 exponent range, so gradients need no loss scaling)
+PRECISION = {
+    'fp32': Precision('float32', 'float32', 'float32', 'float32'),
+    'bf16': Precision('float32', 'bfloat16', 'float32', 'float32'),
+}
+
+
 class PINN2d(nn.Module):
     features: Sequence[int]
+    precision: str = 'fp32'
 
     @nn.compact
     def __call__(self, x, y):
         X = jnp.concatenate([x, y], axis=1)
         init = nn.initializers.glorot_normal()
+        p = PRECISION[self.precision]
+        dense = partial(nn.Dense, kernel_init=init, dtype=p.compute, param_dtype=p.param)
         for fs in self.features[:-1]:
-            X = nn.Dense(fs, kernel_init=init)(X)
+            X = dense(fs)(X)
             X = nn.activation.tanh(X)
-        X = nn.Dense(self.features[-1], kernel_init=init)(X)
-        return X
+        X = dense(self.features[-1])(X)
+        return X.astype(p.tangent)
     
 
 class PINN3d(nn.Module):
     features: Sequence[int]
     out_dim: int
     pos_enc: int
+    precision: str = 'fp32'
 
     @nn.compact
     def __call__(self, x, y, z):
@@ -68,57 +96,117 @@ class PINN3d(nn.Module):
         X = jnp.concatenate([x, y, z], axis=1)
         
         init = nn.initializers.glorot_normal()
+        p = PRECISION[self.precision]
+        dense = partial(nn.Dense, kernel_init=init, dtype=p.compute, param_dtype=p.param)
         for fs in self.features[:-1]:
-            X = nn.Dense(fs, kernel_init=init)(X)
+            X = dense(fs)(X)
             X = nn.activation.tanh(X)
-        X = nn.Dense(self.features[-1], kernel_init=init)(X)
+        X = dense(self.features[-1])(X)
 
-        return X
+        return X.astype(p.tangent)
 
 
 class PINN4d(nn.Module):
     features: Sequence[int]
+    precision: str = 'fp32'
 
     @nn.compact
     def __call__(self, t, x, y, z):
         X = jnp.concatenate([t, x, y, z], axis=1)
         init = nn.initializers.glorot_normal()
+        p = PRECISION[self.precision]
+        dense = partial(nn.Dense, kernel_init=init, dtype=p.compute, param_dtype=p.param)
         for fs in self.features[:-1]:
-            X = nn.Dense(fs, kernel_init=init)(X)
+            X = dense(fs)(X)
             X = nn.activation.tanh(X)
-        X = nn.Dense(self.features[-1], kernel_init=init)(X)
-        return X
+        X = dense(self.features[-1])(X)
+        return X.astype(p.tangent)
+
+
+# merge per-axis features (r*out_dim x n each) into the model prediction
+# 'batched': single einsum over all channels, (out_dim, r, n) factors, along a precomputed optimal path
+# 'streamed': lax.map over the leading axis, the rank-expanded (r x n x n) intermediate is never built;
+#             channels stay separate so XLA can drop derivatives of channels that are never used
+# rank_axis: features only hold this device's slice of the rank axis (rank-parallel model),
+#            the partial predictions are summed over that mesh axis
+# dtype: dtype of the contraction
+def contract_features(outputs, r, out_dim, contraction='batched', rank_axis=None, dtype='float32'):
+    factors = [X.astype(dtype).reshape(out_dim, r, -1) for X in outputs]
+    if contraction == 'batched':
+        axes = 'txyz'[-len(factors):]
+        subscripts = ','.join(f'of{a}' for a in axes) + f'->o{axes}'
+        path = _einsum_path(subscripts, *[f.shape for f in factors])
+        pred = list(jnp.einsum(subscripts, *factors, optimize=path))
+    elif contraction == 'streamed':
+        pred = [_contract_streamed([f[i] for f in factors]) for i in range(out_dim)]
+    else:
+        raise NotImplementedError
+
+    if rank_axis is not None:
+        pred = jax.lax.psum(pred, rank_axis)
+
+    if len(pred) == 1:
+        # 1-dimensional output
+        return pred[0]
+    else:
+        # n-dimensional output
+        return pred
+
+
+# optimal contraction order only depends on the shapes, so it is searched once per shape
+@lru_cache(maxsize=None)
+def _einsum_path(subscripts, *shapes):
+    operands = [jax.ShapeDtypeStruct(shape, jnp.float32) for shape in shapes]
+    return jnp.einsum_path(subscripts, *operands, optimize='optimal')[0]
+
+
+# scale the next factor by one slice of the leading factor at a time,
+# until only a (r x n) x (r x n) matmul is left
+# the slice is recomputed in the backward pass instead of stacking all of them
+def _contract_streamed(factors):
+    if len(factors) == 2:
+        return jnp.dot(factors[0].T, factors[1])
+    body = jax.checkpoint(lambda a: _contract_streamed([a[:, None] * factors[1]] + factors[2:]))
+    return jax.lax.map(body, factors[0].T)
 
 
 class SPINN2d(nn.Module):
     features: Sequence[int]
     r: int
     mlp: str
+    precision: str = 'fp32'
 
     @nn.compact
-    def __call__(self, x, y):
+    def axis_features(self, x, y):
         inputs, outputs = [x, y], []
         init = nn.initializers.glorot_normal()
+        p = PRECISION[self.precision]
+        dense = partial(nn.Dense, kernel_init=init, dtype=p.compute, param_dtype=p.param)
         if self.mlp == 'mlp':
             for X in inputs:
                 for fs in self.features[:-1]:
-                    X = nn.Dense(fs, kernel_init=init)(X)
+                    X = dense(fs)(X)
                     X = nn.activation.tanh(X)
-                X = nn.Dense(self.r, kernel_init=init)(X)
-                outputs += [X]
+                X = dense(self.r)(X)
+                outputs += [jnp.transpose(X, (1, 0)).astype(p.tangent)]
         else:
             for X in inputs:
-                U = nn.activation.tanh(nn.Dense(self.features[0], kernel_init=init)(X))
-                V = nn.activation.tanh(nn.Dense(self.features[0], kernel_init=init)(X))
-                H = nn.activation.tanh(nn.Dense(self.features[0], kernel_init=init)(X))
+                U = nn.activation.tanh(dense(self.features[0])(X))
+                V = nn.activation.tanh(dense(self.features[0])(X))
+                H = nn.activation.tanh(dense(self.features[0])(X))
                 for fs in self.features[:-1]:
-                    Z = nn.Dense(fs, kernel_init=init)(H)
+                    Z = dense(fs)(H)
                     Z = nn.activation.tanh(Z)
                     H = (jnp.ones_like(Z)-Z)*U + Z*V
-                H = nn.Dense(self.r, kernel_init=init)(H)
-                outputs += [H]
+                H = dense(self.r)(H)
+                outputs += [jnp.transpose(H, (1, 0)).astype(p.tangent)]
+
+        return outputs
 
-        return jnp.dot(outputs[0], outputs[-1].T)
+    def __call__(self, x, y):
+        outputs = self.axis_features(x, y)
+        dtype = PRECISION[self.precision].contract
+        return jnp.dot(outputs[0].T.astype(dtype), outputs[-1].astype(dtype))
 
 
 class SPINN3d(nn.Module):
@@ -127,14 +215,15 @@ class SPINN3d(nn.Module):
     out_dim: int
     pos_enc: int
     mlp: str
+    contraction: str = 'batched'
+    rank_axis: str = None
+    precision: str = 'fp32'
 
     @nn.compact
-    def __call__(self, x, y, z):
+    def axis_features(self, x, y, z):
         '''
         inputs: input factorized coordinates
-        outputs: feature output of each body network
-        xy: intermediate tensor for feature merge btw. x and y axis
-        pred: final model prediction (e.g. for 2d output, pred=[u, v])
+        outputs: feature output of each body network (r*out_dim x n per axis)
         '''
         if self.pos_enc != 0:
             # positional encoding only to spatial coordinates
@@ -148,38 +237,40 @@ class SPINN3d(nn.Module):
             #  freq_x = jnp.expand_dims(jnp.power(10.0, jnp.arange(0, 3)), 0)
             # x = x@freq_x
             
-        inputs, outputs, xy, pred = [x, y, z], [], [], []
+        inputs, outputs = [x, y, z], []
         init = nn.initializers.glorot_normal()
+        p = PRECISION[self.precision]
+        dense = partial(nn.Dense, kernel_init=init, dtype=p.compute, param_dtype=p.param)
 
         if self.mlp == 'mlp':
             for X in inputs:
                 for fs in self.features[:-1]:
-                    X = nn.Dense(fs, kernel_init=init)(X)
+                    X = dense(fs)(X)
                     X = nn.activation.tanh(X)
-                X = nn.Dense(self.r*self.out_dim, kernel_init=init)(X)
-                outputs += [jnp.transpose(X, (1, 0))]
+                X = dense(self.r*self.out_dim)(X)
+                outputs += [jnp.transpose(X, (1, 0)).astype(p.tangent)]
 
         elif self.mlp == 'modified_mlp':
             for X in inputs:
-                U = nn.activation.tanh(nn.Dense(self.features[0], kernel_init=init)(X))
-                V = nn.activation.tanh(nn.Dense(self.features[0], kernel_init=init)(X))
-                H = nn.activation.tanh(nn.Dense(self.features[0], kernel_init=init)(X))
+                U = nn.activation.tanh(dense(self.features[0])(X))
+                V = nn.activation.tanh(dense(self.features[0])(X))
+                H = nn.activation.tanh(dense(self.features[0])(X))
                 for fs in self.features[:-1]:
-                    Z = nn.Dense(fs, kernel_init=init)(H)
+                    Z = dense(fs)(H)
                     Z = nn.activation.tanh(Z)
                     H = (jnp.ones_like(Z)-Z)*U + Z*V
-                H = nn.Dense(self.r*self.out_dim, kernel_init=init)(H)
-                outputs += [jnp.transpose(H, (1, 0))]
-
-        for i in range(self.out_dim):
+                H = dense(self.r*self.out_dim)(H)
+                outputs += [jnp.transpose(H, (1, 0)).astype(p.tangent)]
 
-            maxr = self.r + self.r*i
-            # maxr = min([self.r, self.r * 50 // 100]) + self.r * i
+        return outputs
 
-            xy += [jnp.einsum('fx, fy->fxy',
-                              outputs[0][self.r*i:maxr],
-                              outputs[1][self.r*i:maxr])]
-            pred += [jnp.einsum('fxy, fz->xyz', xy[i], outputs[-1][self.r*i:maxr])]
+    def __call__(self, x, y, z):
+        '''
+        outputs: feature output of each body network
+        pred: final model prediction (e.g. for 2d output, pred=[u, v])
+        '''
+        outputs = self.axis_features(x, y, z)
+        pred = contract_features(outputs, self.r, self.out_dim, self.contraction, self.rank_axis, PRECISION[self.precision].contract)
 
         #     for i in range(self.out_dim):
         #         for X in inputs:
@@ -211,12 +302,7 @@ class SPINN3d(nn.Module):
         #     zz = jnp.repeat(zz[:, :, jnp.newaxis,  :], outputs[1].shape[1], axis=2)
         #     pred += [jnp.sum(xx, axis=0) * jnp.sum(yy, axis=0) * jnp.sum(zz, axis=0)]
 
-        if len(pred) == 1:
-            # 1-dimensional output
-            return pred[0]
-        else:
-            # n-dimensional output
-            return pred
+        return pred
 
 
 class SPINN4d(nn.Module):
@@ -224,58 +310,50 @@ class SPINN4d(nn.Module):
     r: int
     out_dim: int
     mlp: str
+    contraction: str = 'batched'
+    rank_axis: str = None
+    precision: str = 'fp32'
 
     @nn.compact
-    def __call__(self, t, x, y, z):
-        inputs, outputs, tx, txy, pred = [t, x, y, z], [], [], [], []
-        # inputs, outputs = [t, x, y, z], []
+    def axis_features(self, t, x, y, z):
+        inputs, outputs = [t, x, y, z], []
         init = nn.initializers.glorot_normal()
+        p = PRECISION[self.precision]
+        dense = partial(nn.Dense, kernel_init=init, dtype=p.compute, param_dtype=p.param)
         for X in inputs:
             for fs in self.features[:-1]:
-                X = nn.Dense(fs, kernel_init=init)(X)
+                X = dense(fs)(X)
                 X = nn.activation.tanh(X)
-            X = nn.Dense(self.r*self.out_dim, kernel_init=init)(X)
-            outputs += [jnp.transpose(X, (1, 0))]
-
-        for i in range(self.out_dim):
-            tx += [jnp.einsum('ft, fx->ftx', 
-            outputs[0][self.r*i:self.r*(i+1)], 
-            outputs[1][self.r*i:self.r*(i+1)])]
-
-            txy += [jnp.einsum('ftx, fy->ftxy', 
-            tx[i], 
-            outputs[2][self.r*i:self.r*(i+1)])]
-
-            pred += [jnp.einsum('ftxy, fz->txyz', 
-            txy[i], 
-            outputs[3][self.r*i:self.r*(i+1)])]
+            X = dense(self.r*self.out_dim)(X)
+            outputs += [jnp.transpose(X, (1, 0)).astype(p.tangent)]
+        return outputs
 
-
-        if len(pred) == 1:
-            # 1-dimensional output
-            return pred[0]
-        else:
-            # n-dimensional output
-            return pred
+    def __call__(self, t, x, y, z):
+        outputs = self.axis_features(t, x, y, z)
+        return contract_features(outputs, self.r, self.out_dim, self.contraction, self.rank_axis, PRECISION[self.precision].contract)
 
 class SPINNnd(nn.Module):
     features: Sequence[int]
     r: int
+    precision: str = 'fp32'
 
     @nn.compact
-    def __call__(self, t, *x):
-        inputs = [t, *x]
-        dim = len(inputs)
-        # inputs, outputs, tx, txy, pred = [t, x, y, z], [], [], [], []
-        # inputs, outputs = [t, x, y, z], []
-        outputs = []
+    def axis_features(self, t, *x):
+        inputs, outputs = [t, *x], []
         init = nn.initializers.glorot_normal()
+        p = PRECISION[self.precision]
+        dense = partial(nn.Dense, kernel_init=init, dtype=p.compute, param_dtype=p.param)
         for X in inputs:
             for fs in self.features[:-1]:
-                X = nn.Dense(fs, kernel_init=init)(X)
+                X = dense(fs)(X)
                 X = nn.activation.tanh(X)
-            X = nn.Dense(self.r, kernel_init=init)(X)
-            outputs += [jnp.transpose(X, (1, 0))]
+            X = dense(self.r)(X)
+            outputs += [jnp.transpose(X, (1, 0)).astype(p.tangent)]
+        return outputs
+
+    def __call__(self, t, *x):
+        outputs = [X.astype(PRECISION[self.precision].contract) for X in self.axis_features(t, *x)]
+        dim = len(outputs)
 
         # einsum(a,b->c)
         a = 'za'
@@ -1,4 +1,3 @@
-for i in 0 1 2 3 4 5 6 7 8 9
-do
-    XLA_PYTHON_CLIENT_PREALLOCATE=false CUDA_VISIBLE_DEVICES=0 python /root/SPINN/Boussinesq_convection_flow_3d.py --step_idx=$i
-done
\ No newline at end of file
+# all time windows in one process (--march=1); IC_pred/ is still written, so a single window
+# can be rerun on its own with --step_idx=<i> --march=0
+XLA_PYTHON_CLIENT_PREALLOCATE=false CUDA_VISIBLE_DEVICES=0 python /root/SPINN/Boussinesq_convection_flow_3d.py --step_idx=0 --march=1
@@ -0,0 +1,34 @@
+# error vs. step time of each precision policy (--precision), same settings as the training scripts
+# on shorter runs; summary in results/precision_benchmark.csv
+# (Boussinesq_convection_flow_3d takes its settings from configs/boussinesq.yaml: set 'precision' there;
+# klein_gordon4d has no --plot_iter)
+EPOCHS=${EPOCHS:-5000}
+LOG_ITER=${LOG_ITER:-1000}
+LOG_DIR=results/precision_benchmark
+mkdir -p $LOG_DIR
+echo "run,precision,ms/iter,error" > results/precision_benchmark.csv
+
+run() {
+    name=$1
+    shift
+    for precision in fp32 bf16
+    do
+        log=$LOG_DIR/${name}_${precision}.log
+        XLA_PYTHON_CLIENT_PREALLOCATE=false CUDA_VISIBLE_DEVICES=0 python "$@" --epochs=$EPOCHS --log_iter=$LOG_ITER --precision=$precision | tee $log
+        ms=$(grep -o '[0-9.]*ms/iter' $log | tail -1 | sed 's#ms/iter##')
+        error=$(grep -o 'error: [0-9.e+-]*' $log | tail -1 | cut -d' ' -f2)
+        echo "$name,$precision,$ms,$error" >> results/precision_benchmark.csv
+    done
+}
+
+run diffusion3d_pinn diffusion3d.py --data_dir=./data/diffusion3d --model=pinn --equation=diffusion3d --nc=16 --seed=111 --lr=0.001 --mlp=modified_mlp --n_layers=5 --features=128 --out_dim=1 --pos_enc=0 --plot_iter=1000000
+run diffusion3d_spinn diffusion3d.py --data_dir=./data/diffusion3d --model=spinn --equation=diffusion3d --nc=64 --seed=111 --lr=0.001 --mlp=modified_mlp --n_layers=4 --features=64 --r=32 --out_dim=1 --pos_enc=0 --plot_iter=1000000
+run helmholtz3d_pinn helmholtz3d.py --model=pinn --equation=helmholtz3d --nc=16 --nc_test=100 --seed=222 --lr=0.001 --mlp=modified_mlp --n_layers=5 --features=128 --out_dim=1 --pos_enc=0 --a1=4 --a2=4 --a3=3 --plot_iter=1000000
+run helmholtz3d_spinn helmholtz3d.py --model=spinn --equation=helmholtz3d --nc=16 --nc_test=100 --seed=111 --lr=0.001 --mlp=modified_mlp --n_layers=4 --features=64 --r=32 --out_dim=1 --pos_enc=0 --a1=4 --a2=4 --a3=3 --plot_iter=1000000
+run klein_gordon3d_pinn klein_gordon3d.py --model=pinn --equation=klein_gordon3d --nc=16 --nc_test=100 --seed=111 --lr=0.001 --mlp=modified_mlp --n_layers=5 --features=128 --out_dim=1 --pos_enc=0 --k=2 --plot_iter=1000000
+run klein_gordon3d_spinn klein_gordon3d.py --model=spinn --equation=klein_gordon3d --nc=64 --nc_test=100 --seed=111 --lr=0.001 --mlp=modified_mlp --n_layers=4 --features=64 --r=32 --out_dim=1 --pos_enc=0 --k=2 --plot_iter=1000000
+run klein_gordon4d_pinn klein_gordon4d.py --model=pinn --equation=klein_gordon4d --nc=16 --nc_test=50 --seed=111 --lr=1e-3 --mlp=modified_mlp --n_layers=5 --features=128 --out_dim=1 --k=2
+run klein_gordon4d_spinn klein_gordon4d.py --model=spinn --equation=klein_gordon4d --nc=64 --nc_test=50 --seed=111 --lr=1e-3 --mlp=modified_mlp --n_layers=4 --features=64 --r=32 --out_dim=1 --k=1
+# first time-marching window only
+run navier_stokes3d navier_stokes3d.py --data_dir=./data/navier_stokes --model=spinn --equation=navier_stokes3d --nt=32 --nxy=256 --seed=111 --lr=0.002 --mlp=modified_mlp --n_layers=3 --features=128 --r=128 --out_dim=2 --pos_enc=5 --offset_num=8 --offset_iter=100 --marching_steps=10 --step_idx=0 --plot_iter=1000000
+run navier_stokes4d navier_stokes4d.py --model=spinn --equation=navier_stokes4d --nc=32 --nc_test=20 --seed=111 --lr=1e-3 --mlp=modified_mlp --n_layers=5 --features=64 --r=128 --out_dim=3 --lbda_c=100 --lbda_ic=10 --plot_iter=1000000
@@ -0,0 +1,77 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+
+# pytree of arrays to an .npz of its leaves, in flattening order (plain arrays, nothing
+# pickled; the tree structure is given back by load_tree's template), written to a temporary
+# file first so a crash never leaves a partial checkpoint behind
+def save_tree(path, tree):
+    leaves = jax.device_get(jax.tree_util.tree_leaves(tree))
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, *leaves)
+    os.replace(path + '.tmp', path)
+
+
+# pytree written by save_tree, with the structure and dtypes of template (so compiled
+# functions see the same shapes and dtypes as before the checkpoint)
+def load_tree(path, template):
+    leaves, treedef = jax.tree_util.tree_flatten(template)
+    with np.load(path, allow_pickle=False) as f:
+        if len(f.files) != len(leaves):
+            raise ValueError(f'{path}: {len(f.files)} arrays, {len(leaves)} expected')
+        arrays = [jnp.asarray(f[f'arr_{i}'], jnp.result_type(leaf)) for i, leaf in enumerate(leaves)]
+    return jax.tree_util.tree_unflatten(treedef, arrays)
+
+
+class CheckpointWriter:
+    '''
+    checkpoints (save_tree) written by a background thread, so the training loop never
+    waits on the device-to-host copy or the disk
+    at most one write is pending: save waits for the previous one first
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.pool = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+
+    def save(self, tree):
+        self.wait()
+        self.pending = self.pool.submit(save_tree, self.path, tree)
+
+    def wait(self):
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+
+    def close(self):
+        self.wait()
+        self.pool.shutdown()
+
+
+class SnapshotWriter:
+    '''
+    files written by a background thread: write returns at once (after the previous writes
+    are done), and wait/close wait for the pending ones, raising the first error of any of them
+    (so a failed write is never mistaken for a written file)
+    save_fn(path, data) writes one file
+    '''
+    def __init__(self):
+        self.pool = ThreadPoolExecutor(max_workers=1)
+        self.pending = []
+
+    def write(self, path, save_fn, data):
+        self.wait()
+        self.pending.append(self.pool.submit(save_fn, path, data))
+
+    def wait(self):
+        pending, self.pending = self.pending, []
+        for future in pending:
+            future.result()
+
+    def close(self):
+        self.wait()
+        self.pool.shutdown()
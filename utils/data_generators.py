@@ -1,10 +1,85 @@
+import json
 import os
+import tempfile
+import zipfile
 from utils.data_utils import *
 
 import jax
+import numpy as np
 import scipy.io
 
 
+#=========================== reference data cache ==========================#
+# .mat reference/IC files are loaded once per process (keyed by path and
+# modification time), the train and test generators get the same NumPy arrays
+# (dtypes as in the file, e.g. float64 times). The first load writes an .npz
+# sidecar next to the file (under a unique temporary name, so concurrent
+# processes never write into the same file), later runs read that instead of
+# parsing the .mat again; a sidecar that cannot be written (read-only data
+# directory) or read (broken) is skipped and the .mat parsed.
+_mat_cache = {}
+
+
+def load_mat(path):
+    path = os.path.abspath(path)
+    key = (path, os.path.getmtime(path))
+    if key not in _mat_cache:
+        sidecar = os.path.splitext(path)[0] + '.npz'
+        data = None
+        if os.path.exists(sidecar) and os.path.getmtime(sidecar) >= key[1]:
+            try:
+                with np.load(sidecar, allow_pickle=False) as f:
+                    data = dict(f)
+            except (OSError, ValueError, EOFError, zipfile.BadZipFile):
+                data = None
+        if data is None:
+            data = {k: v for k, v in scipy.io.loadmat(path).items() if not k.startswith('__')}
+            _write_sidecar(sidecar, data)
+        _mat_cache[key] = data
+    return _mat_cache[key]
+
+
+def _write_sidecar(sidecar, data):
+    tmp = None
+    try:
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(sidecar), suffix='.tmp', delete=False) as f:
+            tmp = f.name
+            np.savez(f, **data)
+        os.replace(tmp, sidecar)
+    except OSError:
+        if tmp is not None and os.path.exists(tmp):
+            os.remove(tmp)
+
+
+#========================= per-axis collocation draw ========================#
+# uniform draw on [minval, maxval], or from a density (coords, weights, mix)
+# built by axis_densities: piecewise constant over bins of the interval, each
+# bin weighted by the mean residual marginal of the current coordinates in it,
+# blended with the uniform density (share mix) so the whole axis stays covered
+def sample_axis(key, shape, minval, maxval, density=None):
+    if density is None:
+        return jax.random.uniform(key, shape, minval=minval, maxval=maxval)
+    coords, weights, mix = density
+    n_bins = max(coords.shape[0] // 4, 1)
+    idx = jnp.clip(((coords - minval) / (maxval - minval) * n_bins).astype(jnp.int32), 0, n_bins - 1)
+    counts = jax.ops.segment_sum(jnp.ones_like(weights), idx, n_bins)
+    w = jax.ops.segment_sum(weights, idx, n_bins) / jnp.maximum(counts, 1.)
+    p = (1. - mix) * w / jnp.maximum(jnp.sum(w), jnp.finfo(w.dtype).tiny) + mix / n_bins
+    # inverse cdf, linear within each bin
+    cdf = jnp.concatenate([jnp.zeros(1), jnp.cumsum(p)]) / jnp.sum(p)
+    u = jax.random.uniform(key, shape)
+    b = jnp.clip(jnp.searchsorted(cdf, u, side='right') - 1, 0, n_bins - 1)
+    s = (b + (u - cdf[b]) / jnp.maximum(cdf[b+1] - cdf[b], jnp.finfo(cdf.dtype).tiny)) / n_bins
+    return minval + (maxval - minval) * jnp.clip(s, 0., 1.)
+
+
+# per-axis densities (for sample_axis) from the squared residual r2 over the
+# current collocation grid (axes coords), marginalised onto each axis
+def axis_densities(coords, r2, mix=0.2):
+    axes = range(r2.ndim)
+    return tuple((c.ravel(), jnp.mean(r2, axis=tuple(j for j in axes if j != i)), mix) for i, c in zip(axes, coords))
+
+
 #========================== diffusion equation 3-d =========================#
 #---------------------------------- PINN -----------------------------------#
 @partial(jax.jit, static_argnums=(0,))
@@ -50,12 +125,13 @@ def _pinn_train_generator_diffusion3d(nc, key):
 
 #---------------------------------- SPINN ----------------------------------#
 @partial(jax.jit, static_argnums=(0,))
-def _spinn_train_generator_diffusion3d(nc, key):
+def _spinn_train_generator_diffusion3d(nc, key, density=None):
     keys = jax.random.split(key, 3)
+    density = (None,) * 3 if density is None else density
     # colocation points
-    tc = jax.random.uniform(keys[0], (nc, 1), minval=0., maxval=1.)
-    xc = jax.random.uniform(keys[1], (nc, 1), minval=-1., maxval=1.)
-    yc = jax.random.uniform(keys[2], (nc, 1), minval=-1., maxval=1.)
+    tc = sample_axis(keys[0], (nc, 1), 0., 1., density[0])
+    xc = sample_axis(keys[1], (nc, 1), -1., 1., density[1])
+    yc = sample_axis(keys[2], (nc, 1), -1., 1., density[2])
     # initial points
     ti = jnp.zeros((1, 1))
     xi = xc
@@ -116,16 +192,16 @@ def _pinn_train_generator_helmholtz3d(a1, a2, a3, nc, key):
 
 #---------------------------------- SPINN ----------------------------------#
 @partial(jax.jit, static_argnums=(0, 1, 2, 3,))
-def _spinn_train_generator_helmholtz3d(a1, a2, a3, nc, key):
+def _spinn_train_generator_helmholtz3d(a1, a2, a3, nc, key, density=None):
     keys = jax.random.split(key, 3)
+    density = (None,) * 3 if density is None else density
     # collocation points
-    xc = jax.random.uniform(keys[0], (nc,), minval=-1., maxval=1.)
-    yc = jax.random.uniform(keys[1], (nc,), minval=-1., maxval=1.)
-    zc = jax.random.uniform(keys[2], (nc,), minval=-1., maxval=1.)
-    # source term
-    xcm, ycm, zcm = jnp.meshgrid(xc, yc, zc, indexing='ij')
-    uc = helmholtz3d_source_term(a1, a2, a3, xcm, ycm, zcm)
+    xc = sample_axis(keys[0], (nc,), -1., 1., density[0])
+    yc = sample_axis(keys[1], (nc,), -1., 1., density[1])
+    zc = sample_axis(keys[2], (nc,), -1., 1., density[2])
     xc, yc, zc = xc.reshape(-1, 1), yc.reshape(-1, 1), zc.reshape(-1, 1)
+    # source term, kept as per-axis factor tables
+    uc = helmholtz3d_source_factors(a1, a2, a3, xc, yc, zc)
     # boundary (hard-coded)
     xb = [jnp.array([[1.]]), jnp.array([[-1.]]), xc, xc, xc, xc]
     yb = [yc, yc, jnp.array([[1.]]), jnp.array([[-1.]]), yc, yc]
@@ -168,26 +244,25 @@ def _pinn_train_generator_klein_gordon3d(nc, k, key):
         jnp.array([[-1.]]*nb),
         jnp.array([[1.]]*nb)
     ]
-    ub = []
-    for i in range(4):
-        ub += [klein_gordon3d_exact_u(tb[i], xb[i], yb[i], k)]
     tb = jnp.concatenate(tb)
     xb = jnp.concatenate(xb)
     yb = jnp.concatenate(yb)
-    ub = jnp.concatenate(ub)
+    # all faces at once
+    ub = klein_gordon3d_exact_u(tb, xb, yb, k)
     return tc, xc, yc, uc, ti, xi, yi, ui, tb, xb, yb, ub
 
 
 #---------------------------------- SPINN ----------------------------------#
 @partial(jax.jit, static_argnums=(0,))
-def _spinn_train_generator_klein_gordon3d(nc, k, key):
+def _spinn_train_generator_klein_gordon3d(nc, k, key, density=None):
     keys = jax.random.split(key, 3)
+    density = (None,) * 3 if density is None else density
     # collocation points
-    tc = jax.random.uniform(keys[0], (nc, 1), minval=0., maxval=10.)
-    xc = jax.random.uniform(keys[1], (nc, 1), minval=-1., maxval=1.)
-    yc = jax.random.uniform(keys[2], (nc, 1), minval=-1., maxval=1.)
-    tc_mesh, xc_mesh, yc_mesh = jnp.meshgrid(tc.ravel(), xc.ravel(), yc.ravel(), indexing='ij')
-    uc = klein_gordon3d_source_term(tc_mesh, xc_mesh, yc_mesh, k)
+    tc = sample_axis(keys[0], (nc, 1), 0., 10., density[0])
+    xc = sample_axis(keys[1], (nc, 1), -1., 1., density[1])
+    yc = sample_axis(keys[2], (nc, 1), -1., 1., density[2])
+    # source term, kept as per-axis factor tables
+    uc = klein_gordon3d_source_factors(tc, xc, yc, k)
     # initial points
     ti = jnp.zeros((1, 1))
     xi = xc
@@ -198,10 +273,8 @@ def _spinn_train_generator_klein_gordon3d(nc, k, key):
     tb = [tc, tc, tc, tc]
     xb = [jnp.array([[-1.]]), jnp.array([[1.]]), xc, xc]
     yb = [yc, yc, jnp.array([[-1.]]), jnp.array([[1.]])]
-    ub = []
-    for i in range(4):
-        tb_mesh, xb_mesh, yb_mesh = jnp.meshgrid(tb[i].ravel(), xb[i].ravel(), yb[i].ravel(), indexing='ij')
-        ub += [klein_gordon3d_exact_u(tb_mesh, xb_mesh, yb_mesh, k)]
+    # all faces from one evaluation of the per-axis factors
+    ub = face_values(partial(klein_gordon3d_exact_u_factors, k=k), tb, xb, yb)
     return tc, xc, yc, uc, ti, xi, yi, ui, tb, xb, yb, ub
 
 
@@ -210,8 +283,7 @@ def _spinn_train_generator_klein_gordon3d(nc, k, key):
 
 #============== _spinn_train_generator_Boussinesq_convection_flow_3d =======#
 #---------------------------------- SPINN ----------------------------------#
-def _spinn_train_generator_Boussinesq_convection_flow_3d(time_end, nt, nxy, data_dir, result_dir, marching_steps, step_idx, offset_num, key):
-    keys = jax.random.split(key, 2)
+def _spinn_train_generator_Boussinesq_convection_flow_3d(time_end, nt, nxy, data_dir, result_dir, marching_steps, step_idx, ic=None):
     # collocation points
     tc = jnp.expand_dims(jnp.linspace(start=0., stop=time_end, num=nt, endpoint=False), axis=1)
     xc = jnp.expand_dims(jnp.linspace(start=0., stop=2.*jnp.pi, num=nxy, endpoint=False), axis=1)
@@ -225,8 +297,8 @@ def _spinn_train_generator_Boussinesq_convection_flow_3d(time_end, nt, nxy, data
         ti_mesh, xi_mesh, yi_mesh = jnp.meshgrid(ti.ravel(), xi.ravel(), yi.ravel(), indexing='ij')
         w0, u0, v0, rho0 = Boussinesq_convection_flow_3d__initialvalue(ti_mesh, xi_mesh, yi_mesh)
     else:
-        # get data from previous time window prediction
-        w0_loaded = scipy.io.loadmat(os.path.join(result_dir, '..', f'IC_pred/w0_{step_idx}.mat'))
+        # get data from previous time window prediction (passed in memory, or from IC_pred)
+        w0_loaded = ic if ic is not None else load_mat(os.path.join(result_dir, '..', f'IC_pred/w0_{step_idx}.mat'))
         ti = w0_loaded['t']
         w0 = w0_loaded['w0']
         u0 = w0_loaded['u0']
@@ -242,26 +314,8 @@ def _spinn_train_generator_Boussinesq_convection_flow_3d(time_end, nt, nxy, data
         else:
             tc = jnp.expand_dims(jnp.linspace(start=Dt * step_idx, stop=Dt * (step_idx+1), num=nt, endpoint=False), axis=1)
 
-    # for stacking multi-input grid
-    tc_mult = jnp.expand_dims(tc, axis=0)
-    xc_mult = jnp.expand_dims(xc, axis=0)
-    yc_mult = jnp.expand_dims(yc, axis=0)
-
-    # maximum value of offsets
-    dt = tc[1][0] - tc[0][0]
-    dxy = xc[1][0] - xc[0][0]
-
-    # create offset values (zero is included by default)
-    offset_t = jax.random.uniform(keys[0], (offset_num-1,), minval=0., maxval=dt)
-    offset_xy = jax.random.uniform(keys[1], (offset_num-1,), minval=0., maxval=dxy)
-
-    # make multi-grid
-    for i in range(offset_num-1):
-        tc_mult = jnp.concatenate((tc_mult, jnp.expand_dims(tc + offset_t[i], axis= 0)), axis=0)
-        xc_mult = jnp.concatenate((xc_mult, jnp.expand_dims(xc + offset_xy[i], axis=0)), axis=0)
-        yc_mult = jnp.concatenate((yc_mult, jnp.expand_dims(yc + offset_xy[i], axis=0)), axis=0)
-
-    return tc_mult, xc_mult, yc_mult, ti, xi, yi, w0, u0, v0, rho0
+    # base grid only, offset grids are derived from it in the training step (make_offset_grids)
+    return tc, xc, yc, ti, xi, yi, w0, u0, v0, rho0
 
 #======================== Klein-Gordon equation 4-d ========================#
 #---------------------------------- PINN -----------------------------------#
@@ -314,30 +368,27 @@ def _pinn_train_generator_klein_gordon4d(nc, k, key):
         jnp.array([[-1.]]*nb),
         jnp.array([[1.]]*nb),
     ]
-    ub = []
-    for i in range(6):
-        ub += [klein_gordon4d_exact_u(tb[i], xb[i], yb[i], zb[i], k)]
     tb = jnp.concatenate(tb)
     xb = jnp.concatenate(xb)
     yb = jnp.concatenate(yb)
     zb = jnp.concatenate(zb)
-    ub = jnp.concatenate(ub)
+    # all faces at once
+    ub = klein_gordon4d_exact_u(tb, xb, yb, zb, k)
     return tc, xc, yc, zc, uc, ti, xi, yi, zi, ui, tb, xb, yb, zb, ub
 
 
 #---------------------------------- SPINN ----------------------------------#
 @partial(jax.jit, static_argnums=(0,))
-def _spinn_train_generator_klein_gordon4d(nc, k, key):
+def _spinn_train_generator_klein_gordon4d(nc, k, key, density=None):
     keys = jax.random.split(key, 4)
+    density = (None,) * 4 if density is None else density
     # collocation points
-    tc = jax.random.uniform(keys[0], (nc, 1), minval=0., maxval=10.)
-    xc = jax.random.uniform(keys[1], (nc, 1), minval=-1., maxval=1.)
-    yc = jax.random.uniform(keys[2], (nc, 1), minval=-1., maxval=1.)
-    zc = jax.random.uniform(keys[3], (nc, 1), minval=-1., maxval=1.)
-    tcm, xcm, ycm, zcm = jnp.meshgrid(
-        tc.ravel(), xc.ravel(), yc.ravel(), zc.ravel(), indexing='ij'
-    )
-    uc = klein_gordon4d_source_term(tcm, xcm, ycm, zcm, k)
+    tc = sample_axis(keys[0], (nc, 1), 0., 10., density[0])
+    xc = sample_axis(keys[1], (nc, 1), -1., 1., density[1])
+    yc = sample_axis(keys[2], (nc, 1), -1., 1., density[2])
+    zc = sample_axis(keys[3], (nc, 1), -1., 1., density[3])
+    # source term, kept as per-axis factor tables
+    uc = klein_gordon4d_source_factors(tc, xc, yc, zc, k)
     # initial points
     ti = jnp.zeros((1, 1))
     xi = xc
@@ -352,20 +403,15 @@ def _spinn_train_generator_klein_gordon4d(nc, k, key):
     xb = [jnp.array([[-1.]]), jnp.array([[1.]]), xc, xc, xc, xc]
     yb = [yc, yc, jnp.array([[-1.]]), jnp.array([[1.]]), yc, yc]
     zb = [zc, zc, zc, zc, jnp.array([[-1.]]), jnp.array([[1.]])]
-    ub = []
-    for i in range(6):
-        tbm, xbm, ybm, zbm = jnp.meshgrid(
-            tb[i].ravel(), xb[i].ravel(), yb[i].ravel(), zb[i].ravel(), indexing='ij'
-        )
-        ub += [klein_gordon4d_exact_u(tbm, xbm, ybm, zbm, k)]
+    # all faces from one evaluation of the per-axis factors
+    ub = face_values(partial(klein_gordon4d_exact_u_factors, k=k), tb, xb, yb, zb)
     return tc, xc, yc, zc, uc, ti, xi, yi, zi, ui, tb, xb, yb, zb, ub
 
 
 #======================== Navier-Stokes equation 3-d ========================#
 #---------------------------------- SPINN -----------------------------------#
-def _spinn_train_generator_navier_stokes3d(nt, nxy, data_dir, result_dir, marching_steps, step_idx, offset_num, key):
-    keys = jax.random.split(key, 2)
-    gt_data = scipy.io.loadmat(os.path.join(data_dir, 'w_data.mat'))
+def _spinn_train_generator_navier_stokes3d(nt, nxy, data_dir, result_dir, marching_steps, step_idx, ic=None):
+    gt_data = load_mat(os.path.join(data_dir, 'w_data.mat'))
     t = gt_data['t']
 
     # initial points
@@ -376,8 +422,8 @@ def _spinn_train_generator_navier_stokes3d(nt, nxy, data_dir, result_dir, marchi
         # get data from ground truth
         w0 = gt_data
     else:
-        # get data from previous time window prediction
-        w0 = scipy.io.loadmat(os.path.join(result_dir, '..', f'IC_pred/w0_{step_idx}.mat'))
+        # get data from previous time window prediction (passed in memory, or from IC_pred)
+        w0 = ic if ic is not None else load_mat(os.path.join(result_dir, '..', f'IC_pred/w0_{step_idx}.mat'))
         ti = w0['t']
 
     # collocation points
@@ -394,43 +440,77 @@ def _spinn_train_generator_navier_stokes3d(nt, nxy, data_dir, result_dir, marchi
         else:
             tc = jnp.expand_dims(jnp.linspace(start=w0['t'][0][0], stop=Dt*(step_idx+1), num=nt, endpoint=False), axis=1)
 
-    # for stacking multi-input grid
-    tc_mult = jnp.expand_dims(tc, axis=0)
-    xc_mult = jnp.expand_dims(xc, axis=0)
-    yc_mult = jnp.expand_dims(yc, axis=0)
+    # base grid only, offset grids are derived from it in the training step (make_offset_grids)
+    return tc, xc, yc, ti, xi, yi, w0['w0'], w0['u0'], w0['v0']
+
+
+#========================== offset grid scheduler ==========================#
+# offset grids of the NS3d/Boussinesq collocation grid (t, x, y leading the training data),
+# derived from the base grid and the offset index inside the compiled training step,
+# so any number of offsets costs no memory beyond the base grid
+# offset idx shifts t by a fraction of dt and x, y (together) by a fraction of dxy:
+#   'random': offset_num > 0 cycles through the base grid and the offset_num-1 uniform draws
+#             the stacked grids made from the same key (the same offsets, seed for seed),
+#             offset_num = 0 gives a fresh offset (keyed by idx) for every idx
+#   'stratified': latin hypercube over offset_num strata of (t, xy), jittered anew every cycle
+#                 (no strata for offset_num = 0: fresh offsets as 'random')
+#   'halton': low-discrepancy halton sequence (bases 2, 3), cycled every offset_num if > 0
+def make_offset_grids(mode, offset_num, key):
+    def fractions(idx):
+        if mode == 'random' and offset_num > 0:
+            # the draws of the stacked grids (from the dataset key), base grid first
+            keys = jax.random.split(key, 2)
+            u = jnp.stack([jnp.concatenate((jnp.zeros(1), jax.random.uniform(k, (offset_num-1,)))) for k in keys])
+            return u[:, idx % offset_num]
+        elif mode in ('random', 'stratified') and offset_num == 0:
+            u = jax.random.uniform(jax.random.fold_in(key, idx), (2,))
+            return jnp.where(idx == 0, 0., u)
+        elif mode == 'stratified':
+            k = idx % offset_num
+            keys = jax.random.split(jax.random.fold_in(key, idx // offset_num), 2)
+            strata = jnp.stack([k, jax.random.permutation(keys[0], offset_num)[k]])
+            return (strata + jax.random.uniform(keys[1], (offset_num, 2))[k]) / offset_num
+        elif mode == 'halton':
+            if offset_num > 0:
+                idx = idx % offset_num
+            return jnp.stack([_radical_inverse(idx, 2), _radical_inverse(idx, 3)])
+        else:
+            raise NotImplementedError
 
-    # maximum value of offsets
-    dt = tc[1][0] - tc[0][0]
-    dxy = xc[1][0] - xc[0][0]
+    def offset_fn(data, idx):
+        tc, xc, yc = data[:3]
+        u = fractions(idx)
+        # maximum value of offsets
+        dt = tc[1][0] - tc[0][0]
+        dxy = xc[1][0] - xc[0][0]
+        return (tc + u[0]*dt, xc + u[1]*dxy, yc + u[1]*dxy, *data[3:])
 
-    # create offset values (zero is included by default)
-    offset_t = jax.random.uniform(keys[0], (offset_num-1,), minval=0., maxval=dt)
-    offset_xy = jax.random.uniform(keys[1], (offset_num-1,), minval=0., maxval=dxy)
+    return offset_fn
 
-    # make multi-grid
-    for i in range(offset_num-1):
-        tc_mult = jnp.concatenate((tc_mult, jnp.expand_dims(tc + offset_t[i], axis= 0)), axis=0)
-        xc_mult = jnp.concatenate((xc_mult, jnp.expand_dims(xc + offset_xy[i], axis=0)), axis=0)
-        yc_mult = jnp.concatenate((yc_mult, jnp.expand_dims(yc + offset_xy[i], axis=0)), axis=0)
 
-    return tc_mult, xc_mult, yc_mult, ti, xi, yi, w0['w0'], w0['u0'], w0['v0']
+# base-b digits of i mirrored around the radix point (i-th point of the van der corput sequence)
+def _radical_inverse(i, base, digits=32):
+    f, r = 1., 0.
+    for _ in range(digits):
+        f = f / base
+        r = r + f * (i % base)
+        i = i // base
+    return r
 
 
 #======================== Navier-Stokes equation 4-d ========================#
 #---------------------------------- SPINN -----------------------------------#
 @partial(jax.jit, static_argnums=(0,))
-def _spinn_train_generator_navier_stokes4d(nc, nu, key):
+def _spinn_train_generator_navier_stokes4d(nc, nu, key, density=None):
     keys = jax.random.split(key, 4)
+    density = (None,) * 4 if density is None else density
     # collocation points
-    tc = jax.random.uniform(keys[0], (nc, 1), minval=0., maxval=5.)
-    xc = jax.random.uniform(keys[1], (nc, 1), minval=0., maxval=2.*jnp.pi)
-    yc = jax.random.uniform(keys[2], (nc, 1), minval=0., maxval=2.*jnp.pi)
-    zc = jax.random.uniform(keys[3], (nc, 1), minval=0., maxval=2.*jnp.pi)
-
-    tcm, xcm, ycm, zcm = jnp.meshgrid(
-        tc.ravel(), xc.ravel(), yc.ravel(), zc.ravel(), indexing='ij'
-    )
-    fc = navier_stokes4d_forcing_term(tcm, xcm, ycm, zcm, nu)
+    tc = sample_axis(keys[0], (nc, 1), 0., 5., density[0])
+    xc = sample_axis(keys[1], (nc, 1), 0., 2.*jnp.pi, density[1])
+    yc = sample_axis(keys[2], (nc, 1), 0., 2.*jnp.pi, density[2])
+    zc = sample_axis(keys[3], (nc, 1), 0., 2.*jnp.pi, density[3])
+    # forcing term, kept as per-axis factor tables
+    fc = navier_stokes4d_forcing_factors(tc, xc, yc, zc, nu)
 
     # initial points
     ti = jnp.zeros((1, 1))
@@ -447,16 +527,16 @@ def _spinn_train_generator_navier_stokes4d(nc, nu, key):
     xb = [jnp.array([[-1.]]), jnp.array([[1.]]), xc, xc, xc, xc]
     yb = [yc, yc, jnp.array([[-1.]]), jnp.array([[1.]]), yc, yc]
     zb = [zc, zc, zc, zc, jnp.array([[-1.]]), jnp.array([[1.]])]
-    wb = []
-    for i in range(6):
-        tbm, xbm, ybm, zbm = jnp.meshgrid(
-            tb[i].ravel(), xb[i].ravel(), yb[i].ravel(), zb[i].ravel(), indexing='ij'
-        )
-        wb += [navier_stokes4d_exact_w(tbm, xbm, ybm, zbm, nu)]
+    # all faces from one evaluation of the per-axis factors (components stacked)
+    wb = face_values(partial(navier_stokes4d_exact_w_factors, nu=nu), tb, xb, yb, zb)
     return tc, xc, yc, zc, fc, ti, xi, yi, zi, wi, ui, tb, xb, yb, zb, wb
 
 
-def generate_train_data(args, key, result_dir=None):
+# density: per-axis collocation densities (axis_densities) for the SPINN generators
+# drawing random collocation axes, uniform if None
+# ic: initial condition of a time-marching window (as returned by save_next_IC),
+# read from IC_pred/w0_{step_idx}.mat if None
+def generate_train_data(args, key, result_dir=None, density=None, ic=None):
     eqn = args.equation
     if args.model == 'pinn':
         if eqn == 'diffusion3d':
@@ -480,31 +560,31 @@ def generate_train_data(args, key, result_dir=None):
     elif args.model == 'spinn':
         if eqn == 'diffusion3d':
             data = _spinn_train_generator_diffusion3d(
-                args.nc, key
+                args.nc, key, density
             )
         elif eqn == 'helmholtz3d':
             data = _spinn_train_generator_helmholtz3d(
-                args.a1, args.a2, args.a3, args.nc, key
+                args.a1, args.a2, args.a3, args.nc, key, density
             )
         elif eqn == 'klein_gordon3d':
             data = _spinn_train_generator_klein_gordon3d(
-                args.nc, args.k, key
+                args.nc, args.k, key, density
             )
         elif eqn == 'klein_gordon4d':
             data = _spinn_train_generator_klein_gordon4d(
-                args.nc, args.k, key
+                args.nc, args.k, key, density
             )
         elif eqn == 'navier_stokes3d':
             data = _spinn_train_generator_navier_stokes3d(
-                args.nt, args.nxy, args.data_dir, result_dir, args.marching_steps, args.step_idx, args.offset_num, key
+                args.nt, args.nxy, args.data_dir, result_dir, args.marching_steps, args.step_idx, ic
             )
         elif eqn == 'Boussinesq_convection_flow_3d':
             data = _spinn_train_generator_Boussinesq_convection_flow_3d(
-                args.time_end, args.nt, args.nxy, args.data_dir, result_dir, args.marching_steps, args.step_idx, args.offset_num, key
+                args.time_end, args.nt, args.nxy, args.data_dir, result_dir, args.marching_steps, args.step_idx, ic
             )
         elif eqn == 'navier_stokes4d':
             data = _spinn_train_generator_navier_stokes4d(
-                args.nc, args.nu, key
+                args.nc, args.nu, key, density
             )
         else:
             raise NotImplementedError
@@ -513,23 +593,83 @@ def generate_train_data(args, key, result_dir=None):
     return data
 
 
+class TrainSampler:
+    '''
+    training data kept on device and resampled inside the compiled training step
+    (see make_train_steps), so the host never waits on generate_train_data
+    data: current batch, used until the next resample
+    period: resample at every 'period'-th epoch, before its step
+    residual_fn: (params, *data) -> squared residual over the collocation grid;
+                 if set, the collocation axes of a new batch are drawn from its
+                 per-axis marginals (axis_densities), with a 'mix' share of uniform
+    '''
+    residual_fn = None
+    mix = 0.2
+
+    def __init__(self, args, key, period=100, result_dir=None):
+        self.args, self.key, self.period = args, key, period
+        self.data = generate_train_data(args, key, result_dir=result_dir)
+
+    def __call__(self, data, e, params=None):
+        # batch for epoch e, a fresh one (keyed by e) on period boundaries
+        def new_data():
+            density = None
+            if self.residual_fn is not None:
+                r2 = self.residual_fn(params, *data)
+                density = axis_densities(data[:r2.ndim], r2, self.mix)
+            return generate_train_data(self.args, jax.random.fold_in(self.key, e), density=density)
+        return jax.lax.cond(e % self.period == 0, new_data, lambda: tuple(data))
+
+
 #============================== test dataset ===============================#
 #------------------------- diffusion equation 3-d --------------------------#
-@partial(jax.jit, static_argnums=(0, 1,))
-def _test_generator_diffusion3d(model, data_dir):
-    u_gt, tt = [], 0.
-    for _ in range(101):
-        u_gt += [jnp.load(os.path.join(data_dir, f'heat_gaussian_{tt:.2f}.npy'))]
-        tt += 0.01
-    u_gt = jnp.stack(u_gt)
-    t = jnp.linspace(0., 1., u_gt.shape[0])
-    x = jnp.linspace(-1., 1., u_gt.shape[1])
-    y = jnp.linspace(-1., 1., u_gt.shape[2])
-    t = jax.lax.stop_gradient(t)
-    x = jax.lax.stop_gradient(x)
-    y = jax.lax.stop_gradient(y)
-    tm, xm, ym = jnp.meshgrid(t, x, y, indexing='ij')
+# reference solution in one store: every snapshot stacked in a single .npy
+# (nt, nx, ny) read through a memory map, axes and time stamps in a .json
+DIFFUSION3D_STORE = 'heat_gaussian'
+
+
+def convert_diffusion3d(data_dir, x_range=(-1., 1.), y_range=(-1., 1.)):
+    # per-snapshot files heat_gaussian_{t:.2f}.npy, ordered by time stamp
+    prefix = DIFFUSION3D_STORE + '_'
+    files = [f for f in os.listdir(data_dir) if f.startswith(prefix) and f.endswith('.npy')]
+    t = sorted(float(f[len(prefix):-len('.npy')]) for f in files)
+    u0 = np.load(os.path.join(data_dir, f'{prefix}{t[0]:.2f}.npy'))
+    # written snapshot by snapshot, never holds the whole solution in memory
+    path = os.path.join(data_dir, DIFFUSION3D_STORE)
+    u_gt = np.lib.format.open_memmap(path + '.tmp.npy', mode='w+', dtype=np.float32, shape=(len(t), *u0.shape))
+    for i, tt in enumerate(t):
+        u_gt[i] = np.load(os.path.join(data_dir, f'{prefix}{tt:.2f}.npy'))
+    u_gt.flush()
+    del u_gt
+    os.replace(path + '.tmp.npy', path + '.npy')
+    with open(path + '.json', 'w') as f:
+        json.dump({'t': t, 'x': list(x_range), 'y': list(y_range)}, f)
+    return path
+
+
+def load_diffusion3d(data_dir, t_range=None):
+    # converted from the per-snapshot files on first use
+    path = os.path.join(data_dir, DIFFUSION3D_STORE)
+    if not (os.path.exists(path + '.npy') and os.path.exists(path + '.json')):
+        convert_diffusion3d(data_dir)
+    with open(path + '.json') as f:
+        meta = json.load(f)
+    u_gt = np.load(path + '.npy', mmap_mode='r')
+    t = np.asarray(meta['t'], dtype=np.float32)
+    x = np.linspace(*meta['x'], u_gt.shape[1], dtype=np.float32)
+    y = np.linspace(*meta['y'], u_gt.shape[2], dtype=np.float32)
+    # time window [t0, t1]: a lazy slice of the memory map, only read when used
+    i0, i1 = 0, len(t)
+    if t_range is not None:
+        i0 = np.searchsorted(t, t_range[0] - 1e-6, side='left')
+        i1 = np.searchsorted(t, t_range[1] + 1e-6, side='right')
+    return t[i0:i1], x, y, u_gt[i0:i1]
+
+
+@partial(jax.jit, static_argnums=(0,))
+def _test_grid_diffusion3d(model, t, x, y, u_gt):
     if model == 'pinn':
+        tm, xm, ym = jnp.meshgrid(t, x, y, indexing='ij')
         t = tm.reshape(-1, 1)
         x = xm.reshape(-1, 1)
         y = ym.reshape(-1, 1)
@@ -541,6 +681,12 @@ def _test_generator_diffusion3d(model, data_dir):
     return t, x, y, u_gt
 
 
+def _test_generator_diffusion3d(model, data_dir, t_range=None):
+    # only the axes and the solution are copied to device, the grid is built there
+    t, x, y, u_gt = load_diffusion3d(data_dir, t_range)
+    return _test_grid_diffusion3d(model, t, x, y, np.ascontiguousarray(u_gt))
+
+
 #------------------------- Helmholtz equation 3-d --------------------------#
 @partial(jax.jit, static_argnums=(0, 1, 2, 3, 4,))
 def _test_generator_helmholtz3d(model, a1, a2, a3, nc_test):
@@ -550,9 +696,9 @@ def _test_generator_helmholtz3d(model, a1, a2, a3, nc_test):
     x = jax.lax.stop_gradient(x)
     y = jax.lax.stop_gradient(y)
     z = jax.lax.stop_gradient(z)
-    xm, ym, zm = jnp.meshgrid(x, y, z, indexing='ij')
-    u_gt = helmholtz3d_exact_u(a1, a2, a3, xm, ym, zm)
     if model == 'pinn':
+        xm, ym, zm = jnp.meshgrid(x, y, z, indexing='ij')
+        u_gt = helmholtz3d_exact_u(a1, a2, a3, xm, ym, zm)
         x = xm.reshape(-1, 1)
         y = ym.reshape(-1, 1)
         z = zm.reshape(-1, 1)
@@ -561,6 +707,8 @@ def _test_generator_helmholtz3d(model, a1, a2, a3, nc_test):
         x = x.reshape(-1, 1)
         y = y.reshape(-1, 1)
         z = z.reshape(-1, 1)
+        # exact solution kept as per-axis factor tables (never a full grid)
+        u_gt = helmholtz3d_exact_u_factors(a1, a2, a3, x, y, z)
     return x, y, z, u_gt
 
 
@@ -589,7 +737,7 @@ def _test_generator_klein_gordon3d(model, nc_test, k):
 
 #----------------------- Boussinesq convection flow 3-d -------------------------#
 # def _test_generator_Boussinesq_convection_flow_3d(time_end, model, nc_test):
-def _test_generator_Boussinesq_convection_flow_3d(time_end, model, nc_test, data_dir, result_dir, marching_steps, step_idx, nxy):
+def _test_generator_Boussinesq_convection_flow_3d(time_end, model, nc_test, data_dir, result_dir, marching_steps, step_idx, nxy, ic=None):
     t = jnp.linspace(start=0., stop=time_end, num=nc_test)
     x = jnp.linspace(0, 2*jnp.pi, nxy)
     y = jnp.linspace(0, 2*jnp.pi, nxy)
@@ -615,7 +763,7 @@ def _test_generator_Boussinesq_convection_flow_3d(time_end, model, nc_test, data
 
     # get data within current time window
     if step_idx > 0:
-        w0_pred = scipy.io.loadmat(os.path.join(result_dir, '..', f'IC_pred/w0_{step_idx}.mat'))
+        w0_pred = ic if ic is not None else load_mat(os.path.join(result_dir, '..', f'IC_pred/w0_{step_idx}.mat'))
         i = 0
         while t[i] != w0_pred['t'][0][0]:
             i+=1
@@ -642,11 +790,11 @@ def _test_generator_klein_gordon4d(model, nc_test, k):
     x = jax.lax.stop_gradient(x)
     y = jax.lax.stop_gradient(y)
     z = jax.lax.stop_gradient(z)
-    tm, xm, ym, zm = jnp.meshgrid(
-        t, x, y, z, indexing='ij'
-    )
-    u_gt = klein_gordon4d_exact_u(tm, xm, ym, zm, k)
     if model == 'pinn':
+        tm, xm, ym, zm = jnp.meshgrid(
+            t, x, y, z, indexing='ij'
+        )
+        u_gt = klein_gordon4d_exact_u(tm, xm, ym, zm, k)
         t = tm.reshape(-1, 1)
         x = xm.reshape(-1, 1)
         y = ym.reshape(-1, 1)
@@ -657,12 +805,14 @@ def _test_generator_klein_gordon4d(model, nc_test, k):
         x = x.reshape(-1, 1)
         y = y.reshape(-1, 1)
         z = z.reshape(-1, 1)
+        # exact solution kept as per-axis factor tables (never a full grid)
+        u_gt = klein_gordon4d_exact_u_factors(t, x, y, z, k)
     return t, x, y, z, u_gt
 
 
 #----------------------- Navier-Stokes equation 3-d -------------------------#
-def _test_generator_navier_stokes3d(model, data_dir, result_dir, marching_steps, step_idx):
-    ns_data = scipy.io.loadmat(os.path.join(data_dir, 'w_data.mat'))
+def _test_generator_navier_stokes3d(model, data_dir, result_dir, marching_steps, step_idx, ic=None):
+    ns_data = load_mat(os.path.join(data_dir, 'w_data.mat'))
     t = ns_data['t'].reshape(-1, 1)
     x = ns_data['x'].reshape(-1, 1)
     y = ns_data['y'].reshape(-1, 1)
@@ -685,7 +835,7 @@ def _test_generator_navier_stokes3d(model, data_dir, result_dir, marching_steps,
 
     # get data within current time window
     if step_idx > 0:
-        w0_pred = scipy.io.loadmat(os.path.join(result_dir, '..', f'IC_pred/w0_{step_idx}.mat'))
+        w0_pred = ic if ic is not None else load_mat(os.path.join(result_dir, '..', f'IC_pred/w0_{step_idx}.mat'))
         i = 0
         while t[i] != w0_pred['t'][0][0]:
             i+=1
@@ -713,11 +863,11 @@ def _test_generator_navier_stokes4d(model, nc_test, nu):
     x = jax.lax.stop_gradient(x)
     y = jax.lax.stop_gradient(y)
     z = jax.lax.stop_gradient(z)
-    tm, xm, ym, zm = jnp.meshgrid(
-        t, x, y, z, indexing='ij'
-    )
-    w_gt = navier_stokes4d_exact_w(tm, xm, ym, zm, nu)
     if model == 'pinn':
+        tm, xm, ym, zm = jnp.meshgrid(
+            t, x, y, z, indexing='ij'
+        )
+        w_gt = navier_stokes4d_exact_w(tm, xm, ym, zm, nu)
         t = tm.reshape(-1, 1)
         x = xm.reshape(-1, 1)
         y = ym.reshape(-1, 1)
@@ -728,10 +878,13 @@ def _test_generator_navier_stokes4d(model, nc_test, nu):
         x = x.reshape(-1, 1)
         y = y.reshape(-1, 1)
         z = z.reshape(-1, 1)
+        # exact vorticity kept as per-axis factor tables (never a full grid)
+        w_gt = navier_stokes4d_exact_w_factors(t, x, y, z, nu)
     return t, x, y, z, w_gt
 
 
-def generate_test_data(args, result_dir):
+# ic: as in generate_train_data
+def generate_test_data(args, result_dir, ic=None):
     eqn = args.equation
     if eqn == 'diffusion3d':
         data = _test_generator_diffusion3d(
@@ -751,12 +904,12 @@ def generate_test_data(args, result_dir):
         )
     elif eqn == 'navier_stokes3d':
         data = _test_generator_navier_stokes3d(
-            args.model, args.data_dir, result_dir, args.marching_steps, args.step_idx
+            args.model, args.data_dir, result_dir, args.marching_steps, args.step_idx, ic
         )
 
     elif eqn == 'Boussinesq_convection_flow_3d':
         data = _test_generator_Boussinesq_convection_flow_3d(
-            args.time_end, args.model, 10, args.data_dir, result_dir, args.marching_steps, args.step_idx, args.nxy
+            args.time_end, args.model, 10, args.data_dir, result_dir, args.marching_steps, args.step_idx, args.nxy, ic
         )
     elif eqn == 'navier_stokes4d':
         data = _test_generator_navier_stokes4d(
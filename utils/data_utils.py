@@ -2,6 +2,48 @@ from functools import partial
 
 import jax
 import jax.numpy as jnp
+import numpy as np
+
+
+# separable terms sum_r prod_i F_i[a_i, ..., r] over a tensor grid, kept as their
+# per-axis factor tables F_i (n_i x r, or n_i x channels x r) and contracted only
+# where a grid of values is needed
+def contract_factors(factors):
+    idx = 'abcdefgh'[:len(factors)]
+    return jnp.einsum(','.join(f'{i}...r' for i in idx) + f'->...{idx}', *factors)
+
+
+# sum and (pointwise) product of separable terms
+def add_factors(*terms):
+    return tuple(jnp.concatenate(F, axis=-1) for F in zip(*terms))
+
+
+def multiply_factors(A, B):
+    return tuple((a[..., :, None] * b[..., None, :]).reshape(a.shape[:-1] + (-1,)) for a, b in zip(A, B))
+
+
+def scale_factors(A, c):
+    return (c * A[0],) + tuple(A[1:])
+
+
+# per-axis (coordinate, factor table) pairs, split into tiles and sharded along with the grid
+def attach_factors(coords, factors):
+    return tuple(zip(coords, factors))
+
+
+# coordinates and the contracted term over their grid
+def detach_factors(axes):
+    coords, factors = zip(*axes)
+    return (*coords, contract_factors(factors))
+
+
+# a separable term on every face of a boundary, from a single evaluation of its
+# factors (factor_fn(*inputs) -> per-axis tables) over the faces packed along each axis
+# faces: one list of inputs per axis, entry j belonging to face j
+def face_values(factor_fn, *faces):
+    bounds = [np.cumsum([0] + [X.shape[0] for X in axis]) for axis in faces]
+    factors = factor_fn(*[jnp.concatenate(axis) for axis in faces])
+    return [contract_factors([F[b[j]:b[j+1]] for F, b in zip(factors, bounds)]) for j in range(len(faces[0]))]
 
 
 # 3d time-independent helmholtz exact u
@@ -10,6 +52,13 @@ def helmholtz3d_exact_u(a1, a2, a3, x, y, z):
     return jnp.sin(a1*jnp.pi*x) * jnp.sin(a2*jnp.pi*y) * jnp.sin(a3*jnp.pi*z)
 
 
+# factors of the 3d helmholtz exact u (a single product)
+@partial(jax.jit, static_argnums=(0, 1, 2,))
+def helmholtz3d_exact_u_factors(a1, a2, a3, x, y, z):
+    x, y, z = x.reshape(-1, 1), y.reshape(-1, 1), z.reshape(-1, 1)
+    return jnp.sin(a1*jnp.pi*x), jnp.sin(a2*jnp.pi*y), jnp.sin(a3*jnp.pi*z)
+
+
 # 3d time-independent helmholtz source term
 @partial(jax.jit, static_argnums=(0, 1, 2,))
 def helmholtz3d_source_term(a1, a2, a3, x, y, z, lda=1.):
@@ -20,6 +69,13 @@ def helmholtz3d_source_term(a1, a2, a3, x, y, z, lda=1.):
     return uxx + uyy + uzz + lda*u_gt
 
 
+# factors of the 3d helmholtz source term (a single product)
+@partial(jax.jit, static_argnums=(0, 1, 2,))
+def helmholtz3d_source_factors(a1, a2, a3, x, y, z, lda=1.):
+    c = lda - ((a1*jnp.pi)**2 + (a2*jnp.pi)**2 + (a3*jnp.pi)**2)
+    return scale_factors(helmholtz3d_exact_u_factors(a1, a2, a3, x, y, z), c)
+
+
 # 2d time-dependent klein-gordon exact u
 def klein_gordon3d_exact_u(t, x, y, k):
     return (x + y) * jnp.cos(k * t) + (x * y) * jnp.sin(k * t)
@@ -31,6 +87,23 @@ def klein_gordon3d_source_term(t, x, y, k):
     return u**2 - (k**2)*u
 
 
+# factors of the 2d klein-gordon exact u: (x + y)cos(kt) + xy sin(kt)
+def klein_gordon3d_exact_u_factors(t, x, y, k):
+    t, x, y = t.reshape(-1, 1), x.reshape(-1, 1), y.reshape(-1, 1)
+    cos, sin = jnp.cos(k * t), jnp.sin(k * t)
+    return (
+        jnp.concatenate([cos, cos, sin], axis=1),
+        jnp.concatenate([x, jnp.ones_like(x), x], axis=1),
+        jnp.concatenate([jnp.ones_like(y), y, y], axis=1)
+    )
+
+
+# factors of the 2d klein-gordon source term: u**2 - k**2 u
+def klein_gordon3d_source_factors(t, x, y, k):
+    u = klein_gordon3d_exact_u_factors(t, x, y, k)
+    return add_factors(multiply_factors(u, u), scale_factors(u, -k**2))
+
+
 # 2d time-dependent Boussinesq_convection_flow_3d
 def Boussinesq_convection_flow_3d__initialvalue(t, x, y):
 
@@ -67,6 +140,24 @@ def klein_gordon4d_source_term(t, x, y, z, k):
     return u**2 - (k**2)*u
 
 
+# factors of the 3d klein-gordon exact u: (x + y + z)cos(kt) + xyz sin(kt)
+def klein_gordon4d_exact_u_factors(t, x, y, z, k):
+    t, x, y, z = t.reshape(-1, 1), x.reshape(-1, 1), y.reshape(-1, 1), z.reshape(-1, 1)
+    cos, sin = jnp.cos(k * t), jnp.sin(k * t)
+    return (
+        jnp.concatenate([cos, cos, cos, sin], axis=1),
+        jnp.concatenate([x, jnp.ones_like(x), jnp.ones_like(x), x], axis=1),
+        jnp.concatenate([jnp.ones_like(y), y, jnp.ones_like(y), y], axis=1),
+        jnp.concatenate([jnp.ones_like(z), jnp.ones_like(z), z, z], axis=1)
+    )
+
+
+# factors of the 3d klein-gordon source term: u**2 - k**2 u
+def klein_gordon4d_source_factors(t, x, y, z, k):
+    u = klein_gordon4d_exact_u_factors(t, x, y, z, k)
+    return add_factors(multiply_factors(u, u), scale_factors(u, -k**2))
+
+
 # 3d time-dependent navier-stokes forcing term
 def navier_stokes4d_forcing_term(t, x, y, z, nu):
     # forcing terms in the PDE
@@ -79,6 +170,18 @@ def navier_stokes4d_forcing_term(t, x, y, z, nu):
     return f_x, f_y, f_z
 
 
+# factors of the 3d navier-stokes forcing term, one product per component (channels f_x, f_y, f_z)
+def navier_stokes4d_forcing_factors(t, x, y, z, nu):
+    t, x, y, z = t.reshape(-1, 1), x.reshape(-1, 1), y.reshape(-1, 1), z.reshape(-1, 1)
+    e = 6*jnp.exp(-18*nu*t)
+    return (
+        jnp.stack([-e, -e, e], axis=1),
+        jnp.stack([jnp.ones_like(x), jnp.sin(4*x), jnp.sin(4*x)], axis=1),
+        jnp.stack([jnp.sin(4*y), jnp.ones_like(y), jnp.sin(4*y)], axis=1),
+        jnp.stack([jnp.sin(2*z), jnp.sin(2*z), jnp.ones_like(z)], axis=1)
+    )
+
+
 # 3d time-dependent navier-stokes exact vorticity
 def navier_stokes4d_exact_w(t, x, y, z, nu):
     # analytic form of vorticity
@@ -88,10 +191,22 @@ def navier_stokes4d_exact_w(t, x, y, z, nu):
     return w_x, w_y, w_z
 
 
+# factors of the 3d navier-stokes exact vorticity, one product per component (channels w_x, w_y, w_z)
+def navier_stokes4d_exact_w_factors(t, x, y, z, nu):
+    t, x, y, z = t.reshape(-1, 1), x.reshape(-1, 1), y.reshape(-1, 1), z.reshape(-1, 1)
+    e = jnp.exp(-9*nu*t)
+    return (
+        jnp.stack([-3*e, 6*e, -6*e], axis=1),
+        jnp.stack([jnp.sin(2*x), jnp.cos(2*x), jnp.cos(2*x)], axis=1),
+        jnp.stack([jnp.cos(2*y), jnp.sin(2*y), jnp.cos(2*y)], axis=1),
+        jnp.stack([jnp.cos(z), jnp.cos(z), jnp.sin(z)], axis=1)
+    )
+
+
 # 3d time-dependent navier-stokes exact velocity
 def navier_stokes4d_exact_u(t, x, y, z, nu):
     # analytic form of velocity
     u_x = 2*jnp.exp(-9*nu*t)*jnp.cos(2*x)*jnp.sin(2*y)*jnp.sin(z)
     u_y = -1*jnp.exp(-9*nu*t)*jnp.sin(2*x)*jnp.cos(2*y)*jnp.sin(z)
     u_z = -2*jnp.exp(-9*nu*t)*jnp.sin(2*x)*jnp.sin(2*y)*jnp.cos(z)
-    return u_x, u_y, u_z
\ No newline at end of file
+    return u_x, u_y, u_z
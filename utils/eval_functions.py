@@ -1,7 +1,8 @@
 import jax
 import jax.numpy as jnp
 from functools import partial
-from utils.vorticity import velocity_to_vorticity_fwd, velocity_to_vorticity_rev, vorx, vory, vorz
+from utils.data_utils import attach_factors, detach_factors
+from utils.vorticity import velocity_to_vorticity_rev, velocity_vorticity
 
 
 def relative_l2(u, u_gt):
@@ -33,14 +34,14 @@ def _eval3d_ns_pinn(apply_fn, params, *test_data):
 @partial(jax.jit, static_argnums=(0,))
 def _eval3d_ns_spinn(apply_fn, params, *test_data):
     x, y, z, u_gt = test_data
-    pred = velocity_to_vorticity_fwd(apply_fn, params, x, y, z)
+    pred = velocity_vorticity(apply_fn, params, x, y, z)[1]
     return relative_l2(pred, u_gt)
 
 
 @partial(jax.jit, static_argnums=(0,))
 def _eval3d_bous_spinn(apply_fn, params, *test_data):
     x, y, z, u_gt, _, _, _ = test_data
-    pred = velocity_to_vorticity_fwd(apply_fn, params, x, y, z)
+    pred = velocity_vorticity(apply_fn, params, x, y, z)[1]
     return relative_l2(pred, u_gt)
 
 
@@ -53,13 +54,52 @@ def _eval4d(apply_fn, params, *test_data):
 def _eval_ns4d(apply_fn, params, *test_data):
     t, x, y, z, w_gt = test_data
     error = 0
-    wx = vorx(apply_fn, params, t, x, y, z)
-    wy = vory(apply_fn, params, t, x, y, z)
-    wz = vorz(apply_fn, params, t, x, y, z)
+    _, (wx, wy, wz) = velocity_vorticity(apply_fn, params, t, x, y, z)
     error = relative_l2(wx, w_gt[0]) + relative_l2(wy, w_gt[1]) + relative_l2(wz, w_gt[2])
     return error / 3
 
 
+# squared error and squared norm (per channel) of a grid-valued pred_fn(*coords) against a
+# separable ground truth (per-axis factor tables), streamed over tiles of the first axis:
+# one tile of the prediction and of the contracted ground truth exists at a time
+# tiles hold at most max_size grid points (and at least one slice of the first axis)
+def _streamed_sq_errors(pred_fn, coords, factors, max_size=2**22):
+    n, rest = coords[0].shape[0], 1
+    for X in coords[1:]:
+        rest *= X.shape[0]
+    rows = max(d for d in range(1, n + 1) if n % d == 0 and (d * rest <= max_size or d == 1))
+    axes = attach_factors(coords, factors)
+    tiles = jax.tree_util.tree_map(lambda X: X.reshape((n // rows, rows) + X.shape[1:]), axes[0])
+    grid_axes = tuple(range(-len(coords), 0))
+
+    def step(carry, tile):
+        *tile_coords, gt = detach_factors((tile, *axes[1:]))
+        pred = pred_fn(*tile_coords)
+        return (carry[0] + jnp.sum((pred - gt)**2, axis=grid_axes), carry[1] + jnp.sum(gt**2, axis=grid_axes)), None
+
+    gt_shape = jax.eval_shape(lambda: detach_factors(axes)[-1]).shape[:-len(coords)]
+    init = (jnp.zeros(gt_shape), jnp.zeros(gt_shape))
+    (error, norm), _ = jax.lax.scan(step, init, tiles)
+    return error, norm
+
+
+# relative l2 error against factor tables of the exact solution (SPINN)
+@partial(jax.jit, static_argnums=(0,))
+def _eval_factorized(apply_fn, params, *test_data):
+    *coords, u_gt = test_data
+    error, norm = _streamed_sq_errors(lambda *c: apply_fn(params, *c), coords, u_gt)
+    return jnp.sqrt(error / norm)
+
+
+# mean relative l2 error of the vorticity components against factor tables (SPINN)
+@partial(jax.jit, static_argnums=(0,))
+def _eval_ns4d_factorized(apply_fn, params, *test_data):
+    *coords, w_gt = test_data
+    pred_fn = lambda *c: jnp.stack(velocity_vorticity(apply_fn, params, *c)[1])
+    error, norm = _streamed_sq_errors(pred_fn, coords, w_gt)
+    return jnp.mean(jnp.sqrt(error / norm))
+
+
 # temporary code
 def _batch_eval4d(apply_fn, params, *test_data):
     t, x, y, z, u_gt = test_data
@@ -89,13 +129,17 @@ def setup_eval_function(model, equation):
             fn = _eval3d_ns_spinn
         elif model == 'spinn' and equation == 'Boussinesq_convection_flow_3d':
             fn = _eval3d_bous_spinn
+        elif model == 'spinn' and equation == 'helmholtz3d':
+            fn = _eval_factorized
         else:
             fn = _eval3d
     elif dim == '4d':
         if model == 'pinn':
             fn = _batch_eval4d
         if model == 'spinn' and equation == 'navier_stokes4d':
-            fn = _eval_ns4d
+            fn = _eval_ns4d_factorized
+        elif model == 'spinn' and equation == 'klein_gordon4d':
+            fn = _eval_factorized
         else:
             fn = _eval4d
     elif dim == 'nd':
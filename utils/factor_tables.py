@@ -0,0 +1,119 @@
+import json
+
+import numpy as np
+
+
+# A trained SPINN is fully described by its per-axis body networks: its prediction on any grid
+# is the rank contraction of their (out_dim*r x n) feature tables. Exported here either as the
+# 1-D networks themselves ('network') or as feature tables sampled densely along each axis and
+# linearly interpolated ('table'), both into one .npz of plain arrays (nothing pickled), and
+# queried by FactorTables with NumPy alone (no Flax, no jit).
+
+
+# layout of the per-axis body networks of the SPINN built by setup_networks(args)
+# (keyword arguments of export_factor_tables)
+def spinn_layout(args):
+    dim = args.equation[-2:]
+    return {
+        'n_axes': int(dim[0]),
+        'out_dim': args.out_dim if dim in ('3d', '4d') else 1,
+        # SPINN4d has plain MLPs whatever args.mlp
+        'mlp': args.mlp if dim in ('2d', '3d') else 'mlp',
+        # SPINN3d encodes the spatial coordinates only
+        'pos_enc': args.pos_enc if dim == '3d' else 0,
+        'pos_enc_axes': (1, 2) if dim == '3d' else (),
+    }
+
+
+# [[(kernel, bias), ...] per axis]: Flax names the Dense layers in the order they are created,
+# one body network after the other
+def _axis_layers(params, n_axes):
+    layers = params['params']
+    names = sorted(layers, key=lambda name: int(name.split('_')[-1]))
+    per_axis = len(names) // n_axes
+    return [[(np.asarray(layers[name]['kernel'], np.float32), np.asarray(layers[name]['bias'], np.float32))
+             for name in names[a*per_axis:(a+1)*per_axis]] for a in range(n_axes)]
+
+
+# features (out_dim*r x n) of one body network at 1-d coordinates x, as SPINN*d.axis_features
+def _body_network(layers, x, layout, axis):
+    X = x.reshape(-1, 1).astype(np.float32)
+    if axis in layout['pos_enc_axes'] and layout['pos_enc'] != 0:
+        freq = np.arange(1, layout['pos_enc']+1, dtype=np.float32)[None]
+        X = np.concatenate((np.ones_like(X), np.sin(X @ freq), np.cos(X @ freq)), 1)
+    dense = lambda layer, X: X @ layer[0] + layer[1]
+
+    if layout['mlp'] == 'mlp':
+        for layer in layers[:-1]:
+            X = np.tanh(dense(layer, X))
+    else:
+        U, V, H = (np.tanh(dense(layer, X)) for layer in layers[:3])
+        for layer in layers[3:-1]:
+            Z = np.tanh(dense(layer, H))
+            H = (1 - Z)*U + Z*V
+        X = H
+    return dense(layers[-1], X).T
+
+
+# write the factor tables of a SPINN (params of SPINN2d/3d/4d/nd) to path; layout as
+# spinn_layout(args), or for SPINNnd n_axes=len(coordinates) only
+# mode 'network': the 1-D body networks (their weights), exact and resolution-free
+# mode 'table': their features sampled at the 1-d coordinates grids[axis] (sorted), linearly
+#               interpolated in between (and constant beyond the ends)
+def export_factor_tables(path, params, n_axes, out_dim=1, mlp='mlp', pos_enc=0, pos_enc_axes=(), mode='network', grids=None):
+    layers = _axis_layers(params, n_axes)
+    meta = {'mode': mode, 'n_axes': n_axes, 'n_layers': len(layers[0]), 'out_dim': out_dim,
+            'r': layers[0][-1][0].shape[1] // out_dim, 'mlp': mlp, 'pos_enc': pos_enc, 'pos_enc_axes': list(pos_enc_axes)}
+    arrays = {}
+    for a, axis_layers in enumerate(layers):
+        if mode == 'network':
+            for j, (kernel, bias) in enumerate(axis_layers):
+                arrays[f'axis{a}_kernel{j}'], arrays[f'axis{a}_bias{j}'] = kernel, bias
+        elif mode == 'table':
+            grid = np.asarray(grids[a], np.float32).ravel()
+            arrays[f'axis{a}_grid'], arrays[f'axis{a}_features'] = grid, _body_network(axis_layers, grid, meta, a)
+        else:
+            raise NotImplementedError
+    np.savez(path, meta=np.array(json.dumps(meta)), **arrays)
+
+
+class FactorTables:
+    '''
+    SPINN prediction from exported factor tables (export_factor_tables), with NumPy alone
+    __call__(*coords): on the grid of the 1-d coordinate arrays (any shape, raveled), as the
+                       model would; a scalar coordinate evaluates a slice (that axis dropped)
+    points(*coords): at the points (coords[0][i], coords[1][i], ...)
+    both give one array per output channel (a list, if out_dim > 1)
+    '''
+    def __init__(self, path):
+        with np.load(path, allow_pickle=False) as f:
+            self.meta = json.loads(str(f['meta']))
+            self.arrays = {k: f[k] for k in f.files if k != 'meta'}
+
+    def features(self, axis, x):
+        # (out_dim x r x n) features of one axis at 1-d coordinates x
+        x = np.asarray(x, np.float32).ravel()
+        if self.meta['mode'] == 'network':
+            layers = [(self.arrays[f'axis{axis}_kernel{j}'], self.arrays[f'axis{axis}_bias{j}']) for j in range(self.meta['n_layers'])]
+            F = _body_network(layers, x, self.meta, axis)
+        else:
+            grid, table = self.arrays[f'axis{axis}_grid'], self.arrays[f'axis{axis}_features']
+            i = np.clip(np.searchsorted(grid, x) - 1, 0, len(grid) - 2)
+            w = np.clip((x - grid[i]) / (grid[i+1] - grid[i]), 0., 1.)
+            F = table[:, i]*(1 - w) + table[:, i+1]*w
+        return F.reshape(self.meta['out_dim'], self.meta['r'], -1)
+
+    def __call__(self, *coords):
+        factors = [self.features(a, c) for a, c in enumerate(coords)]
+        idx = 'abcdefgh'[:len(factors)]
+        pred = np.einsum(','.join(f'or{i}' for i in idx) + f'->o{idx}', *factors, optimize=True)
+        # scalar coordinates: slices
+        pred = pred.reshape(pred.shape[:1] + tuple(F.shape[-1] for F, c in zip(factors, coords) if np.ndim(c) > 0))
+        return self._channels(pred)
+
+    def points(self, *coords):
+        pred = np.prod([self.features(a, c) for a, c in enumerate(coords)], axis=0).sum(axis=1)
+        return self._channels(pred)
+
+    def _channels(self, pred):
+        return pred[0] if len(pred) == 1 else list(pred)
@@ -1,33 +1,18 @@
-from utils.vorticity import velocity_to_vorticity_fwd
+from functools import partial
+from utils.vorticity import divergence, velocity_jacobian, velocity_vorticity
 import jax.numpy as jnp
-from jax import jvp
 import jax
 
 
 def get_residuals(apply_fn, params, t, x, y):
-    # compute [u, v]
-    uv = apply_fn(params, t, x, y)
-
-    vec_t = jnp.ones(t.shape)
-    vec_xy = jnp.ones(x.shape)
-    w_t = jvp(
-        lambda t: velocity_to_vorticity_fwd(apply_fn, params, t, x, y),
-        (t,),
-        (vec_t,)
-    )[1]
-    w_x = jvp(
-        lambda x: velocity_to_vorticity_fwd(apply_fn, params, t, x, y),
-        (x,),
-        (vec_xy,)
-    )[1]
-    w_y = jvp(
-        lambda y: velocity_to_vorticity_fwd(apply_fn, params, t, x, y),
-        (y,),
-        (vec_xy,)
-    )[1]
-    rho_t = jvp(lambda t: apply_fn(params, t, x, y)[2], (t,), (vec_t,))[1]
-    rho_x = jvp(lambda x: apply_fn(params, t, x, y)[2], (x,), (vec_xy,))[1]
-    rho_y = jvp(lambda y: apply_fn(params, t, x, y)[2], (y,), (vec_xy,))[1]
+    # velocity/density [u, v, rho], vorticity and their 1st derivatives along (t, x, y)
+    (uv, w), G = velocity_jacobian(
+        partial(velocity_vorticity, apply_fn),
+        params, t, x, y,
+        argnums=(0, 1, 2)
+    )
+    w_t, w_x, w_y = G[0][1], G[1][1], G[2][1]
+    rho_t, rho_x, rho_y = G[0][0][2], G[1][0][2], G[2][0][2]
 
 
     # PDE constraint
@@ -38,9 +23,7 @@ def get_residuals(apply_fn, params, t, x, y):
     abs_w = jnp.abs(R_w)
 
     # incompressible fluid constraint
-    u_x = jvp(lambda x: apply_fn(params, t, x, y)[0], (x,), (vec_xy,))[1]
-    v_y = jvp(lambda y: apply_fn(params, t, x, y)[1], (y,), (vec_xy,))[1]
-    R_c = u_x + v_y
+    R_c = divergence([G[1][0][:2], G[2][0][:2]])
     abs_c = jnp.abs(R_c)
 
 
@@ -1,66 +1,90 @@
+import glob
+import hashlib
 import os
 import pdb
-from functools import partial
+import sys
+import warnings
+from functools import lru_cache, partial
 
 import jax
 import jax.numpy as jnp
+import numpy as np
 import optax
 import scipy.io
+from jax.sharding import PartitionSpec as P
 from networks.physics_informed_neural_networks import *
 from utils.vorticity import (velocity_to_vorticity_fwd,
-                             velocity_to_vorticity_rev)
+                             velocity_to_vorticity_rev, velocity_vorticity)
 
 
-def setup_networks(args, key):
+# persistent on-disk compilation cache: XLA executables keyed by their program (hence the model
+# configuration and input shapes) and backend, reused by later runs and other processes (time
+# windows) instead of compiled again
+def setup_compilation_cache(cache_dir, min_compile_time=0.1):
+    jax.config.update('jax_compilation_cache_dir', os.path.abspath(cache_dir))
+    jax.config.update('jax_persistent_cache_min_compile_time_secs', min_compile_time)
+    jax.config.update('jax_persistent_cache_min_entry_size_bytes', 0)
+
+
+# rank_devices > 1: per-device model of a rank-parallel run (see rank_parallel), holding
+# r/rank_devices of the rank axis and summing the partial outputs over the 'rank' mesh axis
+# args.precision: dtype policy of the networks (networks.physics_informed_neural_networks.PRECISION)
+# args.cache_dir: persistent compilation cache (setup_compilation_cache), if set
+def setup_networks(args, key, rank_devices=1):
+    if args.cache_dir:
+        setup_compilation_cache(args.cache_dir)
+
     # build network
     dim = args.equation[-2:]
     if args.model == 'pinn':
         # feature sizes
         feat_sizes = tuple([args.features for _ in range(args.n_layers - 1)] + [args.out_dim])
         if dim == '2d':
-            model = PINN2d(feat_sizes)
+            model = PINN2d(feat_sizes, args.precision)
         elif dim == '3d':
-            model = PINN3d(feat_sizes, args.out_dim, args.pos_enc)
+            model = PINN3d(feat_sizes, args.out_dim, args.pos_enc, args.precision)
         elif dim == '4d':
-            model = PINN4d(feat_sizes)
+            model = PINN4d(feat_sizes, args.precision)
         else:
             raise NotImplementedError
     else: # SPINN
         # feature sizes
         feat_sizes = tuple([args.features for _ in range(args.n_layers)])
         if dim == '2d':
-            model = SPINN2d(feat_sizes, args.r, args.mlp)
+            model = SPINN2d(feat_sizes, args.r, args.mlp, args.precision)
         elif dim == '3d':
-            model = SPINN3d(feat_sizes, args.r, args.out_dim, args.pos_enc, args.mlp)
+            model = SPINN3d(feat_sizes, args.r // rank_devices, args.out_dim, args.pos_enc, args.mlp, args.contraction, 'rank' if rank_devices > 1 else None, args.precision)
         elif dim == '4d':
-            model = SPINN4d(feat_sizes, args.r, args.out_dim, args.mlp)
+            model = SPINN4d(feat_sizes, args.r // rank_devices, args.out_dim, args.mlp, args.contraction, 'rank' if rank_devices > 1 else None, args.precision)
         else:
             raise NotImplementedError
     # initialize params
     # dummy inputs must be given
+    # (the per-device model of a rank-parallel run is initialized outside the mesh, without the sum)
+    init_fn = model.clone(rank_axis=None).init if rank_devices > 1 else model.init
     if dim == '2d':
-        params = model.init(
+        params = init_fn(
             key,
             jnp.ones((args.nc, 1)),
             jnp.ones((args.nc, 1))
         )
     elif dim == '3d':
         if args.equation == 'navier_stokes3d' or  args.equation == 'Boussinesq_convection_flow_3d':
-            params = model.init(
+            params = init_fn(
                 key,
                 jnp.ones((args.nt, 1)),
                 jnp.ones((args.nxy, 1)),
                 jnp.ones((args.nxy, 1))
             )
         else:
-            params = model.init(
+            params = init_fn(
                 key,
                 jnp.ones((args.nc, 1)),
                 jnp.ones((args.nc, 1)),
                 jnp.ones((args.nc, 1))
             )
     elif dim == '4d':
-        params = model.init(
+        params = init_fn(
             key,
             jnp.ones((args.nc, 1)),
             jnp.ones((args.nc, 1)),
@@ -70,7 +94,27 @@ def setup_networks(args, key):
     else:
         raise NotImplementedError
 
-    return jax.jit(model.apply), params
+    # 'method' is static so SPINN per-axis features can be queried via apply_fn
+    return jax.jit(model.apply, static_argnames=('method',)), params
+
+
+# params of a time-marching window warm-started from the previous window's SPINN params
+# 'continue': as they are, the temporal body network extrapolates into the new time range; at the
+#             new window's start the model is the previous window's end state, i.e. the new IC,
+#             so this is the mode that keeps the solution continuous
+# 'shift': temporal (first) body network translated by dt, the offset between the two windows,
+#          so the new window repeats the temporal profile learned over the previous one; at its
+#          start the model is the previous window's start state (its IC), not the new IC, so
+#          the IC loss starts off and this only helps when the dynamics repeat window to window
+def warm_start_params(params, args, mode, dt):
+    if mode == 'continue':
+        return params
+    # input layers of the temporal body network: W (t - dt) + b = W t + (b - W dt)
+    layers = dict(params['params'])
+    for i in range(3 if args.mlp == 'modified_mlp' else 1):
+        kernel, bias = layers[f'Dense_{i}']['kernel'], layers[f'Dense_{i}']['bias']
+        layers[f'Dense_{i}'] = {'kernel': kernel, 'bias': (bias - dt * kernel[0]).astype(bias.dtype)}
+    return {**params, 'params': layers}
 
 
 def name_model(args):
@@ -85,7 +129,7 @@ def name_model(args):
         del name[-1]
     if args.equation != 'navier_stokes3d' and  args.equation != 'Boussinesq_convection_flow_3d':
         name.insert(0, f'nc{args.nc}')
-    if args.equation == 'navier_stokes3d' or  args.equation != 'Boussinesq_convection_flow_3d':
+    if args.equation == 'navier_stokes3d':
         name.insert(0, f'nxy{args.nxy}')
         name.insert(0, f'nt{args.nt}')
         name.append(f'on{args.offset_num}')
@@ -101,6 +145,8 @@ def name_model(args):
         name.append(f'k{args.k}')
     
     name.append(f'{args.mlp}')
+    if args.precision != 'fp32':
+        name.append(args.precision)
         
     return '_'.join(name)
 
@@ -119,25 +165,334 @@ def update_model(optim, gradient, params, state):
     return params, state
 
 
-# save next initial condition for time-marching
-def save_next_IC(root_dir, name, apply_fn, params, test_data, step_idx, e):
-    os.makedirs(os.path.join(root_dir, name, 'IC_pred'), exist_ok=True)
+# n_steps training epochs fused into one compiled lax.scan; loss, gradient, optax update,
+# offset-grid switching and best-loss tracking stay on device, only metrics come back
+# step_fn(params, *data) -> (loss, gradient), or with has_aux:
+# step_fn(params, aux, *data) -> (loss, gradient, aux) for extra state carried across steps
+# offset_fn(data, idx) (utils.data_generators.make_offset_grids): data on offset grid idx,
+# switched every offset_iter epochs
+# best loss is checked every best_every epochs after best_from (as in the training loops)
+# sampler (utils.data_generators.TrainSampler): data is taken from and kept in the sampler,
+# and resampled on device within the scan, before the epoch's loss (from the current params
+# for residual-driven sampling), instead of passed in
+# export: prefix of the ahead-of-time export of the fused step (see aot), if set
+def make_train_steps(step_fn, optim, n_steps, best_every=10, best_from=0, offset_fn=None, offset_iter=1, has_aux=False, sampler=None, export=None):
+    @jax.jit
+    def _train_steps(params, state, aux, best, best_params, e, *data):
+        def train_step(carry, e):
+            (params, state, aux, best, best_params), data = carry
+            if sampler is not None:
+                # a new batch is used from the epoch that draws it on
+                data = sampler(data, e, params)
+            # current offset grid
+            data_e = offset_fn(data, e // offset_iter) if offset_fn is not None else data
+
+            if has_aux:
+                loss, gradient, aux = step_fn(params, aux, *data_e)
+            else:
+                loss, gradient = step_fn(params, *data_e)
+            params, state = update_model(optim, gradient, params, state)
+
+            improved = (e % best_every == 0) & (e > best_from) & (loss < best)
+            best = jnp.where(improved, loss, best)
+            best_params = jax.tree_util.tree_map(lambda p, b: jnp.where(improved, p, b), params, best_params)
+            return ((params, state, aux, best, best_params), data), (loss, improved)
+
+        epochs = e + jnp.arange(n_steps)
+        (carry, data), (loss, improved) = jax.lax.scan(train_step, ((params, state, aux, best, best_params), data), epochs)
+        metrics = {'loss': loss, 'improved': jnp.any(improved)}
+        return (carry, metrics) if sampler is None else (carry, metrics, data)
+
+    if export is not None:
+        _train_steps = aot(_train_steps, export)
+
+    def train_steps(params, state, aux, best, best_params, e, *data):
+        # same dtype for the initial (python float) and tracked best loss, compiled once
+        best = jnp.asarray(best, jnp.result_type(float))
+        if sampler is None:
+            return _train_steps(params, state, aux, best, best_params, e, *data)
+        carry, metrics, sampler.data = _train_steps(params, state, aux, best, best_params, e, *sampler.data)
+        return carry, metrics
+
+    return train_steps
+
+
+# key of a run configuration (every setting but the time window and logging) and jax version
+def config_key(args):
+    items = args if isinstance(args, dict) else vars(args)
+    config = sorted((k, v) for k, v in items.items() if k not in ('step_idx', 'log_iter', 'plot_iter'))
+    return hashlib.sha1(f'{jax.__version__} {config}'.encode()).hexdigest()[:16]
+
+
+# hash of the code the kernels are traced from (networks/, utils/, configs/ and the entry script),
+# so exports are never reused after a code change
+@lru_cache(maxsize=None)
+def source_key():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    paths = sorted(path for package in ('networks', 'utils', 'configs') for path in glob.glob(os.path.join(root, package, '*.py')))
+    main = getattr(sys.modules['__main__'], '__file__', None)
+    h = hashlib.sha1()
+    for path in paths + ([os.path.abspath(main)] if main else []):
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()[:16]
+
+
+# prefix of the ahead-of-time exports (aot) of one of a run's kernels, None without args.aot
+# (keyed on the configuration and the source code)
+def export_prefix(args, kernel):
+    if not args.aot:
+        return None
+    return os.path.join(args.cache_dir, 'exported', f'{kernel}_{config_key(args)}_{source_key()}')
+
+
+# namedtuple nodes of a pytree (e.g. optax states), registered for jax.export serialization
+_serializable = set()
+
+
+def _register_namedtuples(tree):
+    if isinstance(tree, tuple) and hasattr(tree, '_fields') and type(tree) not in _serializable:
+        jax.export.register_namedtuple_serialization(type(tree), serialized_name=f'{type(tree).__module__}.{type(tree).__qualname__}')
+        _serializable.add(type(tree))
+    for node in (tree.values() if isinstance(tree, dict) else tree if isinstance(tree, (list, tuple)) else ()):
+        _register_namedtuples(node)
+
+
+# ahead-of-time export (jax.export, serialized StableHLO) of jitted fn, for the shapes and
+# dtypes of its first call, at {prefix}_{shape key}.jax: exported there on the first run and
+# loaded on later ones, which skip tracing fn (and compiling it, with the compilation cache)
+# the first n_static arguments (e.g. apply_fn) are fixed by the first call and not exported
+def aot(fn, prefix, n_static=0):
+    kernels = {}
+
+    def call(*args):
+        static, args = args[:n_static], args[n_static:]
+        avals = [(np.shape(x), str(jnp.result_type(x))) for x in jax.tree_util.tree_leaves(args)]
+        key = hashlib.sha1(f'{jax.tree_util.tree_structure(args)} {avals}'.encode()).hexdigest()[:16]
+        if key not in kernels:
+            path = f'{prefix}_{key}.jax'
+            _register_namedtuples(args)
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    exported = jax.export.deserialize(bytearray(f.read()))
+            else:
+                exported = jax.export.export(jax.jit(partial(fn, *static)))(*args)
+                serialized = exported.serialize()
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'wb') as f:
+                    f.write(serialized)
+            kernels[key] = jax.jit(exported.call)
+        return kernels[key](*args)
+
+    return call
+
+
+# whether a chunk of n_steps epochs ending at epoch e reaches a multiple of period
+def chunk_hits(e, n_steps, period):
+    return e // period > (e - n_steps) // period
+
+
+# split a factorized grid along one axis into n_tiles equal blocks
+# inputs: per-axis coordinates (n_i x 1), or pytrees of arrays along the axis (n_i x ...,
+# e.g. a coordinate with factor tables, see utils.data_utils.attach_factors)
+# fields: arrays over the grid (grid axes last)
+def _split_tiles(inputs, fields, axis, n_tiles):
+    split = lambda X, ax: jnp.moveaxis(X.reshape(X.shape[:ax] + (n_tiles, -1) + X.shape[ax+1:]), ax, 0)
+    coords = jax.tree_util.tree_map(lambda X: split(X, 0), inputs[axis])
+    blocks = jax.tree_util.tree_map(lambda X: split(X, X.ndim - len(inputs) + axis), fields)
+    return coords, blocks
 
-    w_pred = velocity_to_vorticity_fwd(apply_fn, params, jnp.expand_dims(test_data[0][-1], axis=1), test_data[1], test_data[2])
+
+# 1-d device mesh for data-parallel ('grid') or rank-parallel ('rank') training, None on a single device
+# n_devices: number of devices to use (0 for all of jax.devices())
+def setup_mesh(n_devices, axis_name='grid'):
+    devices = jax.devices()[:n_devices] if n_devices > 0 else jax.devices()
+    if len(devices) == 1:
+        return None
+    return jax.make_mesh((len(devices),), (axis_name,), (jax.sharding.AxisType.Auto,), devices=devices)
+
+
+# rank-parallel version of a SPINN step_fn(apply_fn, params, *data) -> (loss, gradient, *aux)
+# the last layer of each body network (kernel and bias, all output channels) is split along
+# the rank axis over the 'rank' mesh axis; each device evaluates and contracts only its slice
+# of the features (and their tangents) and the partial outputs are summed inside the model
+def rank_parallel(step_fn, args, params, mesh):
+    n = mesh.shape['rank']
+    apply_fn, local_params = setup_networks(args, jax.random.PRNGKey(0), rank_devices=n)
+    sliced = jax.tree_util.tree_map(lambda X, L: X.shape != L.shape, params, local_params)
+    # (..., r*out_dim) <-> (..., out_dim, r) views, so the rank axis is split within each channel
+    view = lambda X, s: X.reshape(X.shape[:-1] + (args.out_dim, -1)) if s else X
+    flat = lambda X, s: X.reshape(X.shape[:-2] + (-1,)) if s else X
+    specs = jax.tree_util.tree_map(lambda X, s: P(*[None]*X.ndim, 'rank') if s else P(), params, sliced)
+
+    def shard_fn(params, data):
+        loss, gradient, *aux = step_fn(apply_fn, jax.tree_util.tree_map(flat, params, sliced), *data)
+        # psum transposes to psum, so every device sees n times the output cotangent;
+        # replicated layers only get this device's share of their gradient
+        gradient = jax.tree_util.tree_map(lambda g, s: view(g, s) / n if s else jax.lax.psum(g, 'rank') / n, gradient, sliced)
+        return loss, gradient, aux
+
+    def rank_step_fn(params, *data):
+        params = jax.tree_util.tree_map(view, params, sliced)
+        loss, gradient, aux = jax.shard_map(shard_fn, mesh=mesh, in_specs=(specs, P()), out_specs=(P(), specs, P()), check_vma=False)(params, data)
+        return loss, jax.tree_util.tree_map(flat, gradient, sliced), *aux
+
+    return rank_step_fn
+
+
+# partition specs sharding grid axis 'axis' of inputs and fields over the mesh
+def _grid_specs(inputs, fields, axis):
+    input_specs = tuple(jax.tree_util.tree_map(lambda X: P('grid') if i == axis else P(), X) for i, X in enumerate(inputs))
+    field_specs = jax.tree_util.tree_map(lambda X: P(*[None]*(X.ndim - len(inputs) + axis), 'grid'), fields)
+    return input_specs, field_specs
+
+
+# evaluate a grid-valued fn(*inputs, *fields) one tile at a time and stitch the tiles back
+# body networks act pointwise, so each tile is exactly that block of the full grid output
+# with a mesh, each device evaluates its own block of the grid (tiled within the device)
+def tiled_map(fn, inputs, fields=(), axis=0, n_tiles=1, mesh=None):
+    if mesh is not None:
+        shard_fn = lambda inputs, fields: tiled_map(fn, inputs, fields, axis, n_tiles)
+        out = jax.eval_shape(fn, *inputs, *fields)
+        out_specs = jax.tree_util.tree_map(lambda X: P(*[None]*(X.ndim - len(inputs) + axis), 'grid'), out)
+        return jax.shard_map(shard_fn, mesh=mesh, in_specs=_grid_specs(inputs, fields, axis), out_specs=out_specs, check_vma=False)(inputs, fields)
+    if n_tiles == 1:
+        return fn(*inputs, *fields)
+    tile_fn = lambda tile: fn(*inputs[:axis], tile[0], *inputs[axis+1:], *tile[1])
+    out = jax.lax.map(tile_fn, _split_tiles(inputs, fields, axis, n_tiles))
+    # tile axis back next to the grid axis it was cut from
+    merge = lambda X, ax: jnp.moveaxis(X, 0, ax).reshape(X.shape[1:ax+1] + (-1,) + X.shape[ax+2:])
+    return jax.tree_util.tree_map(lambda X: merge(X, X.ndim - 1 - len(inputs) + axis), out)
+
+
+# value and gradient of a mean-type loss_fn(params, *inputs, *fields) over the full grid,
+# accumulated tile by tile; tiles have equal size, so the full-grid mean is their average
+# with a mesh, the grid is sharded along the same axis and the per-device values and
+# gradients are all-reduced (averaged) across devices
+def tiled_value_and_grad(loss_fn, params, inputs, fields=(), axis=0, n_tiles=1, mesh=None):
+    if mesh is not None:
+        shard_fn = lambda params, inputs, fields: jax.lax.pmean(
+            tiled_value_and_grad(loss_fn, params, inputs, fields, axis, n_tiles), 'grid')
+        return jax.shard_map(shard_fn, mesh=mesh, in_specs=(P(), *_grid_specs(inputs, fields, axis)), out_specs=P(), check_vma=False)(params, inputs, fields)
+    grad_fn = jax.value_and_grad(loss_fn)
+    if n_tiles == 1:
+        return grad_fn(params, *inputs, *fields)
+
+    def step(carry, tile):
+        out = grad_fn(params, *inputs[:axis], tile[0], *inputs[axis+1:], *tile[1])
+        return jax.tree_util.tree_map(jnp.add, carry, out), None
+
+    init = jax.eval_shape(grad_fn, params, *inputs, *fields)
+    init = jax.tree_util.tree_map(lambda X: jnp.zeros(X.shape, X.dtype), init)
+    out, _ = jax.lax.scan(step, init, _split_tiles(inputs, fields, axis, n_tiles))
+    return jax.tree_util.tree_map(lambda X: X / n_tiles, out)
+
+
+# number of tiles along a grid axis of length n for one tile of step_fn to fit in mem_cap (MB)
+# estimated from the compiled footprint of the untiled step (nothing is allocated)
+# with a mesh in step_kwargs, tiles split each device's share of the axis (the axis must split
+# evenly over the devices; checked here, before anything is sharded)
+def tiles_for_memory(step_fn, step_args, n, mem_cap, **step_kwargs):
+    mesh = step_kwargs.get('mesh')
+    if mesh is not None:
+        if n % mesh.size != 0:
+            raise ValueError(f'the sharded grid axis ({n} points) does not split evenly over {mesh.size} devices; '
+                             f'choose --devices (or --shard_axis) so that it does')
+        n //= mesh.size
+    if mem_cap <= 0:
+        return 1
+    stats = step_fn.lower(*step_args, n_tiles=1, **step_kwargs).compile().memory_analysis()
+    if stats is None:
+        return 1
+    n_tiles = -(-stats.temp_size_in_bytes // int(mem_cap * 2**20))
+    # tiles must split the axis evenly
+    return min(d for d in range(min(max(n_tiles, 1), n), n + 1) if n % d == 0)
+
+
+# save next initial condition for time-marching
+# returns it (as generate_train_data/generate_test_data take it for the next window),
+# written to IC_pred/w0_{step_idx+1}.mat only if write (by writer, a background
+# utils.checkpoints.SnapshotWriter, if given)
+def save_next_IC(root_dir, name, apply_fn, params, test_data, step_idx, e, write=True, writer=None):
+    (u0_pred, v0_pred), w_pred = velocity_vorticity(apply_fn, params, jnp.expand_dims(test_data[0][-1], axis=1), test_data[1], test_data[2])
     w_pred = w_pred.reshape(-1, test_data[1].shape[0], test_data[2].shape[0])[0]
-    u0_pred, v0_pred = apply_fn(params, jnp.expand_dims(test_data[0][-1], axis=1), test_data[1], test_data[2])
     u0_pred, v0_pred = jnp.squeeze(u0_pred), jnp.squeeze(v0_pred)
-    
-    scipy.io.savemat(os.path.join(root_dir, name, f'IC_pred/w0_{step_idx+1}.mat'), mdict={'w0': w_pred, 'u0': u0_pred, 'v0': v0_pred, 't': jnp.expand_dims(test_data[0][-1], axis=1)})
+    ic = {'w0': w_pred, 'u0': u0_pred, 'v0': v0_pred, 't': jnp.expand_dims(test_data[0][-1], axis=1)}
 
+    if write:
+        os.makedirs(os.path.join(root_dir, name, 'IC_pred'), exist_ok=True)
+        path = os.path.join(root_dir, name, f'IC_pred/w0_{step_idx+1}.mat')
+        if writer is not None:
+            writer.write(path, lambda path, ic: scipy.io.savemat(path, mdict=ic), ic)
+        else:
+            scipy.io.savemat(path, mdict=ic)
+    return ic
 
-# save next initial condition for time-marching for Boussinesq equation
-def save_next_IC_for_Boussinesq(root_dir, name, apply_fn, params, test_data, step_idx, e):
-    os.makedirs(os.path.join(root_dir, name, 'IC_pred'), exist_ok=True)
 
-    w_pred = velocity_to_vorticity_fwd(apply_fn, params, jnp.expand_dims(test_data[0][-1], axis=1), test_data[1], test_data[2])
+# save next initial condition for time-marching for Boussinesq equation (as save_next_IC)
+def save_next_IC_for_Boussinesq(root_dir, name, apply_fn, params, test_data, step_idx, e, write=True, writer=None):
+    (u0_pred, v0_pred, rho0_pred), w_pred = velocity_vorticity(apply_fn, params, jnp.expand_dims(test_data[0][-1], axis=1), test_data[1], test_data[2])
     w_pred = w_pred.reshape(-1, test_data[1].shape[0], test_data[2].shape[0])[0]
-    u0_pred, v0_pred, rho0_pred = apply_fn(params, jnp.expand_dims(test_data[0][-1], axis=1), test_data[1], test_data[2])
     u0_pred, v0_pred, rho0_pred = jnp.squeeze(u0_pred), jnp.squeeze(v0_pred), jnp.squeeze(rho0_pred)
+    ic = {'w0': w_pred, 'u0': u0_pred, 'v0': v0_pred, 'rho0': rho0_pred, 't': jnp.expand_dims(test_data[0][-1], axis=1)}
+
+    if write:
+        os.makedirs(os.path.join(root_dir, name, 'IC_pred'), exist_ok=True)
+        path = os.path.join(root_dir, name, f'IC_pred/w0_{step_idx+1}.mat')
+        if writer is not None:
+            writer.write(path, lambda path, ic: scipy.io.savemat(path, mdict=ic), ic)
+        else:
+            scipy.io.savemat(path, mdict=ic)
+    return ic
+
+
+# largest relative (l2) difference between the entries of two ICs (None: the data's IC)
+def ic_change(ic, ref):
+    if ic is None or ref is None:
+        return 0. if ic is ref else float('inf')
+    return max(float(np.linalg.norm(ic[k] - ref[k]) / np.linalg.norm(ref[k])) for k in ic if k != 't')
+
 
-    scipy.io.savemat(os.path.join(root_dir, name, f'IC_pred/w0_{step_idx+1}.mat'), mdict={'w0': w_pred, 'u0': u0_pred, 'v0': v0_pred, 'rho0': rho0_pred, 't': jnp.expand_dims(test_data[0][-1], axis=1)})
\ No newline at end of file
+# parareal (parallel-in-time) marching over windows: fine(k, ic) trains window k in full from IC
+# ic and returns the IC it predicts for the next window, coarse(k, ic) is a cheap prediction of
+# the same; every window is trained at once (pool.map) from the current ICs, which are then
+# corrected window by window from their neighbours,
+#   U[k+1] = coarse(k, U'[k]) + fine(k, U[k]) - coarse(k, U[k]),
+# until no IC moves by more than tol (at most n_iters times); the first window's IC comes from
+# the data, and windows whose IC did not move since their last fine run are not trained again
+# (if n_iters run out first, a warning says so, and the windows are brought in line with the
+# last corrected ICs by one more fine run)
+def parareal(fine, coarse, windows, pool, n_iters, tol):
+    n = len(windows)
+    # initial ICs from the coarse predictor alone
+    U, G = [None], []
+    for i in range(n - 1):
+        G.append(coarse(windows[i], U[i]))
+        U.append(G[i])
+
+    F, F_ic = [None]*n, [None]*n
+    for it in range(n_iters):
+        todo = [i for i in range(n) if F[i] is None or ic_change(U[i], F_ic[i]) > tol]
+        for i, ic in zip(todo, pool.map(fine, [windows[i] for i in todo], [U[i] for i in todo])):
+            F[i], F_ic[i] = ic, U[i]
+
+        # correction sweep (coarse predictions of unchanged ICs reused, which leaves the fine ones)
+        V = [None]
+        for i in range(n - 1):
+            g = G[i] if ic_change(V[i], U[i]) == 0 else coarse(windows[i], V[i])
+            V.append(F[i] if g is G[i] else {k: g[k] if k == 't' else g[k] + F[i][k] - G[i][k] for k in g})
+            G[i] = g
+        change = max([ic_change(V[i], U[i]) for i in range(1, n)], default=0.)
+        U = V
+        print(f'Parareal iteration: {it+1}/{n_iters} --> windows trained: {len(todo)}, IC change: {change:.8f}')
+        if change <= tol:
+            break
+    else:
+        # iterations used up: the windows whose IC was just corrected are trained once more from
+        # it, so the results on disk (logs, params, best errors) belong to the returned ICs, which
+        # are still unconverged
+        todo = [i for i in range(n) if ic_change(U[i], F_ic[i]) > tol]
+        list(pool.map(fine, [windows[i] for i in todo], [U[i] for i in todo]))
+        warnings.warn(f'parareal did not converge in {n_iters} iterations (IC change {change:.8f} > {tol}); '
+                      f'{len(todo)} windows retrained from the last corrected ICs, results are unconverged')
+    return U
@@ -52,4 +52,41 @@ def vorz(apply_fn, params, t, x, y, z):
     ux_y = jvp(lambda y: apply_fn(params, t, x, y, z)[0], (y,), (vec_y,))[1]
     uy_x = jvp(lambda x: apply_fn(params, t, x, y, z)[1], (x,), (vec_x,))[1]
     wz = uy_x - ux_y
-    return wz
\ No newline at end of file
+    return wz
+
+def velocity_jacobian(apply_fn, params, *inputs, argnums=None):
+    # velocity and its jacobian w/ forward-mode AD
+    # one tangent per axis is pushed through the model for all output channels
+    # J[j][i] = d(u_i)/d(inputs[argnums[j]]); spatial axes (all but t) by default
+    if argnums is None:
+        argnums = range(1, len(inputs))
+    u, J = None, []
+    for j in argnums:
+        vec = jnp.ones(inputs[j].shape)
+        f = lambda X: apply_fn(params, *inputs[:j], X, *inputs[j+1:])
+        u, u_j = jvp(f, (inputs[j],), (vec,))
+        J += [u_j]
+    return u, J
+
+
+def curl(J):
+    # w = curl u from the spatial jacobian (scalar w = v_x - u_y in 2D)
+    if len(J) == 2:
+        return J[0][1] - J[1][0]
+    return J[1][2] - J[2][1], J[2][0] - J[0][2], J[0][1] - J[1][0]
+
+
+def divergence(J):
+    # div u from the spatial jacobian
+    return sum(J[j][j] for j in range(len(J)))
+
+
+def advection(a, J):
+    # (a . grad) u, e.g. a = u for the convective term, a = w for vortex stretching
+    return [sum(a[j]*J[j][i] for j in range(len(J))) for i in range(len(J))]
+
+
+def velocity_vorticity(apply_fn, params, *inputs):
+    # model output and vorticity from one spatial jacobian
+    u, J = velocity_jacobian(apply_fn, params, *inputs)
+    return u, curl(J)